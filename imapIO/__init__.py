@@ -1,14 +1,24 @@
 'IMAP mailbox wrapper'
+import base64
+import bisect
 import chardet
+import collections
+import copy
+import csv
 import datetime
 import email
 import gzip
+import hashlib
 import imaplib
+import json
 import logging; log = logging.getLogger(__name__)
 import mimetypes
 import os
 import random
 import re
+import threading
+import time
+from array import array
 from calendar import timegm
 from email.generator import Generator
 from email.header import decode_header, HeaderParseError
@@ -18,20 +28,106 @@ from email.utils import mktime_tz, parsedate_tz, formatdate, parseaddr, formatad
 from imapIO import utf_7_imap4
 
 
-__all__ = ['IMAP4', 'IMAP4_SSL', 'IMAPError', 'Email', 'build_message', 'normalize_nickname', 'connect', 'extract']
+# Register MOVE for versions of imaplib that predate RFC 6851
+imaplib.Commands.setdefault('MOVE', ('SELECTED',))
 
 
+__all__ = ['IMAP4', 'IMAP4_SSL', 'IMAPError', 'Email', 'build_message', 'normalize_nickname', 'connect', 'extract', 'parse_threads', 'Checkpoint', 'Monitor', 'MessageBatch', 'RateController']
+
+
+HEADER_FIELDS = 'SUBJECT FROM TO CC BCC DATE'
+THREAD_FIELDS = 'MESSAGE-ID IN-REPLY-TO REFERENCES'
+FETCH_BATCH_SIZE = 100
+# Fetch at most this many bytes of message bodies in one command, unless a single message is larger
+BODY_BATCH_SIZE = 8 * 1024 * 1024
+# Detect the charset of text from a sample of this many bytes
+CHARDET_SAMPLE_SIZE = 64 * 1024
+# Remember encoded attachments that add up to at most this many bytes
+ATTACHMENT_CACHE_SIZE = 64 * 1024 * 1024
+# If requested, stream attachments of at least this many bytes from disk instead of encoding them in memory
+ATTACHMENT_STREAM_SIZE = 1024 * 1024
+# Read this many bytes at a time when streaming, which is a multiple of 57 so that each base64 line is complete
+ATTACHMENT_CHUNK_SIZE = 57 * 1024
 PATTERN_FOLDER = re.compile(r'\((?P<flags>.*?)\) "(?P<delimiter>.*)" (?:\{.*\})?(?P<name>.*)')
 PATTERN_WHITESPACE = re.compile(r'\s+')
 PATTERN_DOMAIN = re.compile(r'@[^,]+|/[^,]+')
+PATTERN_FETCH = re.compile(r'\d+ \(')
+PATTERN_UID = re.compile(r'UID (\d+)')
+PATTERN_SIZE = re.compile(r'RFC822\.SIZE (\d+)')
+PATTERN_STATUS = re.compile(r'(MESSAGES|UIDNEXT) (\d+)')
+PATTERN_MESSAGE_ID = re.compile(r'<[^<>\s]+>')
+PATTERN_THREAD = re.compile(r'\(|\)|\d+')
+PATTERN_THROTTLED = re.compile(r'\[(THROTTLED|UNAVAILABLE|LIMIT|INUSE)\]|too many|rate limit|try again later', re.I)
+# Conservative starting points for providers known to throttle; RateController adapts from there
+RATE_PROFILE_BY_HOST = {
+    'imap.mail.yahoo.com': dict(batchSize=20, maximumBatchSize=100, connectionCount=2, maximumConnectionCount=5),
+    'imap.gmail.com': dict(batchSize=100, maximumBatchSize=500, connectionCount=5, maximumConnectionCount=15),
+    'outlook.office365.com': dict(batchSize=50, maximumBatchSize=200, connectionCount=4, maximumConnectionCount=8),
+}
+
+
+class _AttachmentCache(object):
+    'Encoded attachment parts that build_message() shares across messages and threads'
+
+    def __init__(self, maximumSize):
+        self.maximumSize = maximumSize
+        # Map keys to (part, size), least recently used first
+        self.packByKey = collections.OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            pack = self.packByKey.pop(key, None)
+            if pack is None:
+                return
+            # Move the part to the end so that we evict the least recently used first
+            self.packByKey[key] = pack
+            return pack[0]
+
+    def set(self, key, part, size):
+        if size > self.maximumSize:
+            return
+        with self.lock:
+            if key in self.packByKey:
+                self.size -= self.packByKey.pop(key)[1]
+            self.packByKey[key] = part, size
+            self.size += size
+            while self.size > self.maximumSize:
+                self.size -= self.packByKey.popitem(last=False)[1][1]
+
+    def clear(self):
+        with self.lock:
+            self.packByKey.clear()
+            self.size = 0
+
+
+attachmentCache = _AttachmentCache(ATTACHMENT_CACHE_SIZE)
 
 
 class _IMAPExtension(object):
     'Mixin class that extends the IMAP interface'
 
     host = ''
+    retryCount = 3
+    retryDelay = 1
+    rateController = None
+    # Set monitor to an instance of Monitor to record commands and parsing
+    monitor = None
+    selectedFolder = None
+    # UIDVALIDITY of the folder that _select() selected
+    uidValidity = None
+    sentByteCount = 0
+    receivedByteCount = 0
+    # Map each folder to messageUIDs that _fetch() could not fetch even on their own
+    skippedUIDsByFolder = None
 
     def __init__(self):
+        # Keep the controller when reconnecting so that we remember what the server tolerates
+        if self.rateController is None:
+            self.rateController = RateController.for_host(self.host)
+        if self.skippedUIDsByFolder is None:
+            self.skippedUIDsByFolder = {}
         if 'imap.mail.yahoo.com' == self.host.lower():
             self.xatom('ID ("GUID" "1")')
 
@@ -42,10 +138,96 @@ class _IMAPExtension(object):
         'Format an error that happened with a server'
         return '[%s]\n%s\n%s' % (self, text, str(data))
 
+    def send(self, data):
+        if isinstance(data, _StreamedLiteral):
+            for chunk in data:
+                self.send(chunk)
+            return
+        self.sentByteCount += len(data)
+        return super(_IMAPExtension, self).send(data)
+
+    def read(self, size):
+        data = super(_IMAPExtension, self).read(size)
+        self.receivedByteCount += len(data)
+        return data
+
+    def readline(self):
+        line = super(_IMAPExtension, self).readline()
+        self.receivedByteCount += len(line)
+        return line
+
+    def _simple_command(self, name, *args):
+        if self.monitor is None:
+            return super(_IMAPExtension, self)._simple_command(name, *args)
+        sentByteCount, receivedByteCount = self.sentByteCount, self.receivedByteCount
+        timeStarted = time.time()
+        try:
+            return super(_IMAPExtension, self)._simple_command(name, *args)
+        finally:
+            # Name UID commands after the command that they wrap
+            commandName = 'UID ' + args[0].upper() if 'UID' == name and args else name
+            self.monitor.record('command', commandName, time.time() - timeStarted,
+                self.selectedFolder,
+                self.sentByteCount - sentByteCount,
+                self.receivedByteCount - receivedByteCount)
+
+    def reconnect(self, folder=None):
+        'Reconnect, login and select the folder, waiting longer after each failed attempt'
+        # IMAP4 and IMAP4_SSL define reopen()
+        if not hasattr(self, 'reopen'):
+            raise IMAPError(self.format_error('Could not reconnect to server', 'Server cannot open a new connection'))
+        for retryIndex in xrange(self.retryCount):
+            try:
+                self.shutdown()
+            except Exception:
+                pass
+            time.sleep(self.retryDelay * 2 ** retryIndex)
+            try:
+                self.reopen()
+                self.login(self.user, self.password)
+            except Exception, error:
+                log.warn(self.format_error('Could not reconnect (attempt %s)' % (retryIndex + 1), error))
+                continue
+            if folder is not None:
+                self.cd(folder)
+            return
+        raise IMAPError(self.format_error('Could not reconnect to server', 'Gave up after %s attempts' % self.retryCount))
+
+    def _retry(self, folder, function, *args):
+        'Call the function, reconnecting and trying again if the connection aborts'
+        for retryIndex in xrange(self.retryCount):
+            try:
+                return function(*args)
+            except imaplib.IMAP4.abort, error:
+                log.warn(self.format_error('[%s] Connection aborted' % folder, error))
+                # Servers often say BYE when we send too much
+                self.rateController.record_failure(throttled=True)
+                self.reconnect(folder)
+        return function(*args)
+
+    def _uid(self, folder, *args):
+        'Run a UID command, waiting and trying again if the server says that we are sending too much'
+        for retryIndex in xrange(self.retryCount):
+            r, data = self._retry(folder, self.uid, *args)
+            if r == 'OK' or not is_throttled(data):
+                break
+            self.rateController.record_failure(throttled=True)
+            log.warn(self.format_error('[%s] Throttled' % folder, data))
+            time.sleep(self.rateController.get_delay(self.retryDelay))
+        else:
+            r, data = self._retry(folder, self.uid, *args)
+        if r == 'OK':
+            self.rateController.record_success()
+        return r, data
+
     @property
     def folders(self):
         'Parse folder names'
         self.cd()
+        return self._list_folders()
+
+    def _list_folders(self):
+        'Parse folder names without selecting a folder'
         folders = []
         r, data = self.list()
         if r != 'OK':
@@ -60,24 +242,51 @@ class _IMAPExtension(object):
 
     def cd(self, folder=None):
         'Select the specified folder and return message count'
+        # Set the folder first so that the monitor records SELECT under the folder that it selects
+        self.selectedFolder = folder
         r, data = self.select() if folder is None else self.select(folder)
         if r != 'OK':
             log.warn(self.format_error('[%s] Could not select folder' % folder, data))
             return 0
         return int(data[0])
 
-    def walk(self, include=lambda folder: True, searchCriterion=u'ALL', sortCriterion=u'', shuffleMessages=True):
+    def _select(self, folder):
+        'Select the folder and return message count, raising IMAPError if the server refuses'
+        self.selectedFolder = folder
+        r, data = self.select(folder)
+        if r != 'OK':
+            raise IMAPError(self.format_error('[%s] Could not select folder' % folder, data))
+        # Remember UIDVALIDITY so that we notice if the server renumbered messages
+        code, values = self.response('UIDVALIDITY')
+        self.uidValidity = int(values[-1]) if values and values[-1] else None
+        return int(data[0])
+
+    def walk(self, include=lambda folder: True, searchCriterion=u'ALL', sortCriterion=u'', shuffleMessages=True, checkpoint=None):
         """
         Yield matching messages from matching folders.
         Without arguments, it will yield messages in random order.
         Specify a folder, a list of folders or a function as the first argument.
         See IMAP specification for details on search and sort criteria.
+        Reconnect automatically if the connection aborts.
+        Load headers in batches that the rateController sizes and
+        try again after a pause if the server throttles us.
+        Specify a Checkpoint to skip messages that a previous walk yielded.
+        Saving a checkpoint writes every message yielded from the current folder,
+        so save it periodically rather than after every message.
 
         Yield messages from folders that start with the letter A.
             server.walk(lambda folder: folder.upper().startswith('A'))
 
         Yield messages from non-trash folders.
             server.walk(lambda folder: folder.lower() not in ['trash', 'spam'])
+
+        Resume a walk that was interrupted, saving progress every 1000 messages.
+            checkpoint = imapIO.Checkpoint.load(checkpointPath) if os.path.exists(checkpointPath) else imapIO.Checkpoint()
+            for index, email in enumerate(server.walk(checkpoint=checkpoint), 1):
+                process(email)
+                if index % 1000 == 0:
+                    checkpoint.save(checkpointPath)
+            checkpoint.save(checkpointPath)
         """
         include = make_folderFilter(include)
         searchCriterion = '(%s)' % searchCriterion.encode('utf-8')
@@ -86,37 +295,318 @@ class _IMAPExtension(object):
                 raise IMAPError(self.format_error('SORT not supported by server', self.capabilities))
             sortCriterion = '(%s)' % sortCriterion.encode('utf-8')
         # Walk folders
-        folders = self.folders
+        folders = self._retry(None, lambda: self.folders)
         random.shuffle(folders)
+        if checkpoint and checkpoint.folder in folders:
+            # Finish the interrupted folder first because the checkpoint forgets its messages when we start another
+            folders.remove(checkpoint.folder)
+            folders.insert(0, checkpoint.folder)
         for folder in folders:
             if not include(folder):
                 continue
-            self.cd(folder)
+            if checkpoint and folder in checkpoint.folders:
+                continue
             try:
+                self._retry(folder, self._select, folder)
                 if sortCriterion:
-                    r, data = self.uid('sort', sortCriterion, 'utf-8', searchCriterion)
+                    r, data = self._uid(folder, 'sort', sortCriterion, 'utf-8', searchCriterion)
                 else:
-                    r, data = self.uid('search', 'charset', 'utf-8', searchCriterion)
+                    r, data = self._uid(folder, 'search', 'charset', 'utf-8', searchCriterion)
                 if r != 'OK':
                     raise self.error(data)
-            except self.error, error:
+            except (IMAPError, self.error), error:
                 log.warn(self.format_error("[%s] Could not load messageUIDs" % folder, error))
                 continue
             messageUIDs = [int(x) for x in data[0].split()]
             if shuffleMessages and not sortCriterion:
                 random.shuffle(messageUIDs)
-            # Walk messages
-            for messageUID in messageUIDs:
-                # Load message header
-                try:
-                    r, data = self.uid('fetch', messageUID, '(BODY.PEEK[HEADER.FIELDS (SUBJECT FROM TO CC BCC DATE)])')
-                    if r != 'OK':
-                        raise self.error(data)
-                # If we could not fetch the header, log it and move on
-                except self.error, error:
-                    log.warn(self.format_error('[%s UID=%s] Could not peek at message header' % (folder, messageUID), error))
+            if checkpoint:
+                checkpoint.start(folder, self.uidValidity)
+                messageUIDs = [x for x in messageUIDs if x not in checkpoint.messageUIDs]
+            # Walk messages, loading headers in batches
+            for messageUID, attributes, literal in self._fetch(folder, messageUIDs, '(UID BODY.PEEK[HEADER.FIELDS (%s)])' % HEADER_FIELDS):
+                yield Email(self, messageUID, folder, literal or '')
+                # Record the message only after the caller asks for the next one
+                if checkpoint:
+                    checkpoint.messageUIDs.add(messageUID)
+            if checkpoint:
+                checkpoint.finish(folder)
+
+    def threads(self, folder, algorithm='REFERENCES', searchCriterion=u'ALL'):
+        """
+        Group messages in the folder into conversations and
+        return a list of threads as (email, childPacks) tuples.
+        The email is None for a missing parent that only appears in references.
+        Use the THREAD extension if the server supports the algorithm;
+        otherwise, build the threads locally from batched header fetches.
+        Message bodies are never downloaded.
+
+        Print subjects in each conversation of the inbox.
+            def show(threadPacks, depth=0):
+                for email, childPacks in threadPacks:
+                    print '  ' * depth + (email.subject if email else '')
+                    show(childPacks, depth + 1)
+            show(server.threads('inbox'))
+        """
+        algorithm = algorithm.upper()
+        searchCriterion = '(%s)' % searchCriterion.encode('utf-8')
+        if 'THREAD=' + algorithm in self.capabilities:
+            self._retry(folder, self._select, folder)
+            r, data = self.uid('thread', algorithm, 'utf-8', searchCriterion)
+            if r != 'OK':
+                raise IMAPError(self.format_error('[%s] Could not thread messages' % folder, data))
+            threadPacks = parse_threads(data[0] or '')
+            emailByUID = dict((x.uid, x) for x in self._peek(folder, list(walk_threads(threadPacks))))
+            return map_threads(emailByUID.get, threadPacks)
+        return thread_emails(self._peek(folder, self._search(folder, searchCriterion), THREAD_FIELDS))
+
+    def find_duplicates(self, include=lambda folder: True, searchCriterion=u'ALL'):
+        """
+        Return a list of duplicate groups across matching folders,
+        where each group is a list of emails with identical content.
+        The first email in each group is the one we saw first.
+        Fingerprint messages using Message-ID, date, size, subject and sender
+        and fetch bodies only to confirm messages with matching fingerprints.
+
+        Delete duplicates in every folder except the trash.
+            server.remove_duplicates(server.find_duplicates(lambda folder: folder != 'trash'))
+            server.expunge()
+        """
+        include = make_folderFilter(include)
+        searchCriterion = '(%s)' % searchCriterion.encode('utf-8')
+        query = '(UID RFC822.SIZE BODY.PEEK[HEADER.FIELDS (%s MESSAGE-ID)])' % HEADER_FIELDS
+        # Fingerprint messages using header fields, remembering only where each message is
+        keysByFingerprint = {}
+        for folder in self.folders:
+            if not include(folder):
+                continue
+            try:
+                messageUIDs = self._search(folder, searchCriterion)
+            except IMAPError, error:
+                log.warn(error)
+                continue
+            for messageUID, attributes, literal in self._fetch(folder, messageUIDs, query):
+                valueByKey = HeaderParser().parsestr(literal or '')
+                messageIDs = PATTERN_MESSAGE_ID.findall(valueByKey.get('message-id', ''))
+                match = PATTERN_SIZE.search(attributes)
+                fingerprint = (
+                    messageIDs[0] if messageIDs else None,
+                    parse_timeStamp(valueByKey.get('date')),
+                    int(match.group(1)) if match else None,
+                    decode_text(valueByKey.get('subject', '')).lower(),
+                    format_whom(valueByKey.get_all('from', [])).lower())
+                keysByFingerprint.setdefault(fingerprint, []).append((folder, messageUID))
+        # Most fingerprints are unique, so load emails and hash bodies only for candidates
+        keyGroups, sizeByKey, messageUIDsByFolder = [], {}, {}
+        for fingerprint, keys in keysByFingerprint.iteritems():
+            if len(keys) < 2:
+                continue
+            keyGroups.append(keys)
+            for folder, messageUID in keys:
+                sizeByKey[folder, messageUID] = fingerprint[2] or 0
+                messageUIDsByFolder.setdefault(folder, []).append(messageUID)
+        del keysByFingerprint
+        emailByKey, digestByKey = {}, {}
+        for folder, messageUIDs in messageUIDsByFolder.iteritems():
+            try:
+                self._retry(folder, self._select, folder)
+            except IMAPError, error:
+                log.warn(error)
+                continue
+            for messageUID, attributes, literal in self._fetch(folder, messageUIDs, query):
+                email = emailByKey[folder, messageUID] = Email(self, messageUID, folder, literal or '')
+                match = PATTERN_SIZE.search(attributes)
+                email.size = int(match.group(1)) if match else None
+            # The rateController sizes batches for headers, so bound batches of bodies by their total size
+            for batchUIDs in split_by_size(messageUIDs, [sizeByKey[folder, x] for x in messageUIDs], BODY_BATCH_SIZE):
+                for messageUID, attributes, literal in self._fetch(folder, batchUIDs, '(UID BODY.PEEK[TEXT])'):
+                    digestByKey[folder, messageUID] = hashlib.sha1(literal or '').digest()
+        emailGroups = []
+        for keys in keyGroups:
+            emailsByDigest = {}
+            for key in keys:
+                digest = digestByKey.get(key)
+                # If we could not fetch the body, do not risk calling it a duplicate
+                if digest is None or key not in emailByKey:
                     continue
-                yield Email(self, messageUID, folder, data[0][1])
+                emailsByDigest.setdefault(digest, []).append(emailByKey[key])
+            emailGroups.extend(x for x in emailsByDigest.itervalues() if len(x) > 1)
+        return emailGroups
+
+    def scan(self, include=lambda folder: True, searchCriterion=u'ALL', batchSize=1000):
+        """
+        Yield matching messages from matching folders as MessageBatch instances,
+        where each batch stores up to batchSize messages in columns.
+        Scanning is much cheaper than walking because it fetches headers
+        in batches and does not create an Email for each message.
+
+        Count messages by sender.
+            import collections
+            countBySender = collections.Counter()
+            for batch in server.scan():
+                countBySender.update(batch.senders[x] for x in batch.senderIndices)
+
+        Load messages into pandas.
+            import pandas
+            dataFrame = pandas.concat(pandas.DataFrame(x.as_columns()) for x in server.scan())
+        """
+        include = make_folderFilter(include)
+        searchCriterion = '(%s)' % searchCriterion.encode('utf-8')
+        query = '(UID RFC822.SIZE INTERNALDATE BODY.PEEK[HEADER.FIELDS (DATE FROM SUBJECT)])'
+        # Share dictionaries across batches so that indices stay valid
+        folders, senders, indexBySender, indexByValue = [], [], {}, {}
+        batch = MessageBatch(folders, senders)
+        for folder in self.folders:
+            if not include(folder):
+                continue
+            try:
+                messageUIDs = self._search(folder, searchCriterion)
+            except IMAPError, error:
+                log.warn(error)
+                continue
+            folderIndex = len(folders)
+            folders.append(folder)
+            for messageUID, attributes, literal in self._fetch(folder, messageUIDs, query):
+                valueByKey = parse_headerFields(literal or '')
+                timeStamp = parse_timeStamp(valueByKey.get('date'))
+                if timeStamp is None:
+                    timePack = imaplib.Internaldate2tuple(attributes)
+                    timeStamp = time.mktime(timePack) if timePack else 0
+                match = PATTERN_SIZE.search(attributes)
+                # Senders repeat, so format each distinct value only once
+                value = valueByKey.get('from', '')
+                senderIndex = indexByValue.get(value)
+                if senderIndex is None:
+                    sender = format_whom([value])
+                    senderIndex = indexBySender.get(sender)
+                    if senderIndex is None:
+                        senderIndex = indexBySender[sender] = len(senders)
+                        senders.append(sender)
+                    indexByValue[value] = senderIndex
+                batch.uids.append(messageUID)
+                batch.folderIndices.append(folderIndex)
+                batch.timeStamps.append(int(timeStamp))
+                batch.sizes.append(int(match.group(1)) if match else 0)
+                batch.senderIndices.append(senderIndex)
+                batch.subjects.append(decode_text(valueByKey.get('subject', '')))
+                if len(batch) >= batchSize:
+                    yield batch
+                    batch = MessageBatch(folders, senders)
+        if len(batch):
+            yield batch
+
+    def remove_duplicates(self, emailGroups, targetFolder=None):
+        """
+        Flag all but the first email in each group as deleted or,
+        if targetFolder is specified, move them to the targetFolder.
+        Call expunge() afterwards to purge deleted messages.
+        """
+        messageUIDsByFolder = {}
+        for emails in emailGroups:
+            for email in emails[1:]:
+                messageUIDsByFolder.setdefault(email.folder, []).append(email.uid)
+        for folder, messageUIDs in messageUIDsByFolder.iteritems():
+            self.cd(folder)
+            for messageSet in format_messageSets(messageUIDs):
+                if targetFolder and 'MOVE' in self.capabilities:
+                    r, data = self.uid('move', messageSet, targetFolder)
+                else:
+                    if targetFolder:
+                        r, data = self.uid('copy', messageSet, targetFolder)
+                        if r != 'OK':
+                            raise IMAPError(self.format_error('[%s UID=%s] Could not copy duplicates' % (folder, messageSet), data))
+                    r, data = self.uid('store', messageSet, '+FLAGS', r'(\Deleted)')
+                if r != 'OK':
+                    raise IMAPError(self.format_error('[%s UID=%s] Could not remove duplicates' % (folder, messageSet), data))
+
+    def count_messages(self, include=lambda folder: True):
+        """
+        Return (messageCount, uidNext) by folder for matching folders.
+        Use STATUS, which is much cheaper than selecting each folder.
+        """
+        include = make_folderFilter(include)
+        packByFolder = {}
+        for folder in self._list_folders():
+            if not include(folder):
+                continue
+            r, data = self.status(folder, '(MESSAGES UIDNEXT)')
+            if r != 'OK':
+                log.warn(self.format_error('[%s] Could not get status' % folder, data))
+                continue
+            item = ' '.join(' '.join(x) if isinstance(x, tuple) else x for x in data if x)
+            # Look only at the attributes so that we ignore the folder name
+            valueByKey = dict((key, int(value)) for key, value in PATTERN_STATUS.findall(item[item.rfind('('):]))
+            packByFolder[folder] = valueByKey.get('MESSAGES', 0), valueByKey.get('UIDNEXT', 0)
+        return packByFolder
+
+    def _search(self, folder, searchCriterion):
+        'Select the folder and return messageUIDs that match the formatted searchCriterion'
+        self._retry(folder, self._select, folder)
+        r, data = self._uid(folder, 'search', 'charset', 'utf-8', searchCriterion)
+        if r != 'OK':
+            raise IMAPError(self.format_error('[%s] Could not load messageUIDs' % folder, data))
+        return [int(x) for x in data[0].split()]
+
+    def _peek(self, folder, messageUIDs, extraFields=''):
+        'Fetch message headers in batches and yield an Email for each message'
+        fields = ' '.join(x for x in [HEADER_FIELDS, extraFields] if x)
+        query = '(UID BODY.PEEK[HEADER.FIELDS (%s)])' % fields
+        for messageUID, attributes, literal in self._fetch(folder, messageUIDs, query):
+            yield Email(self, messageUID, folder, literal or '')
+
+    def _fetch(self, folder, messageUIDs, query):
+        """
+        Fetch the query for messages in batches and yield (messageUID, attributes, literal)
+        in the order of messageUIDs.  The rateController sets the size of each batch.
+        If a batch fails, wait and try again with a smaller batch; if it keeps
+        failing, split it in half until we find the messages that fail on their
+        own, skip them and add them to skippedUIDsByFolder.
+        """
+        rateController = self.rateController
+        messageIndex, failureCount = 0, 0
+        # Stack (endIndex, batchSize) for each batch that we are splitting
+        splitPacks = []
+        while messageIndex < len(messageUIDs):
+            while splitPacks and messageIndex >= splitPacks[-1][0]:
+                splitPacks.pop()
+                if not splitPacks:
+                    failureCount = 0
+            if splitPacks:
+                endIndex, batchSize = splitPacks[-1]
+                batchUIDs = messageUIDs[messageIndex:min(messageIndex + min(batchSize, rateController.batchSize), endIndex)]
+            else:
+                batchUIDs = messageUIDs[messageIndex:messageIndex + rateController.batchSize]
+            messageSet = ','.join(str(x) for x in batchUIDs)
+            timeStarted = time.time()
+            try:
+                r, data = self._retry(folder, self.uid, 'fetch', messageSet, query)
+                if r != 'OK':
+                    raise self.error(data)
+            except self.error, error:
+                failureCount += 1
+                if failureCount <= self.retryCount:
+                    rateController.record_failure(throttled=is_throttled(error))
+                    log.warn(self.format_error('[%s UID=%s] Could not fetch messages; trying again' % (folder, messageSet), error))
+                    time.sleep(rateController.get_delay(self.retryDelay))
+                    continue
+                # Try each half once without waiting because the batch failed too often to blame the server
+                if len(batchUIDs) > 1:
+                    splitPacks.append((messageIndex + len(batchUIDs), len(batchUIDs) / 2))
+                    log.warn(self.format_error('[%s UID=%s] Could not fetch messages; splitting batch' % (folder, messageSet), error))
+                    continue
+                log.warn(self.format_error('[%s UID=%s] Could not fetch message; skipping' % (folder, messageSet), error))
+                self.skippedUIDsByFolder.setdefault(folder, []).append(batchUIDs[0])
+                messageIndex += 1
+                continue
+            rateController.record_success(time.time() - timeStarted, len(batchUIDs))
+            messageIndex += len(batchUIDs)
+            # Give retries back only after we finish the batches that we are splitting
+            if not splitPacks:
+                failureCount = 0
+            fetchPackByUID = dict((x[0], x) for x in parse_fetch(data))
+            for messageUID in batchUIDs:
+                if messageUID in fetchPackByUID:
+                    yield fetchPackByUID[messageUID]
 
     def revive(self, targetFolder, message):
         'Upload the message to the targetFolder of the mail server'
@@ -131,7 +621,13 @@ class _IMAPExtension(object):
             folder = targetFolder
         # A message with no date returns None instead of raising KeyError
         messageDate = message['date']
-        r, data = self.append(folder, '', mktime_tz(parsedate_tz(messageDate)) if messageDate else None, message.as_string(False))
+        dateTime = mktime_tz(parsedate_tz(messageDate)) if messageDate else None
+        if getattr(message, 'streamedPathByIndex', None):
+            # Send the literal in chunks so that we never hold the whole message in memory
+            self.literal = _StreamedLiteral(message)
+            r, data = self._simple_command('APPEND', folder, None, imaplib.Time2Internaldate(dateTime) if dateTime else None)
+        else:
+            r, data = self.append(folder, '', dateTime, message.as_string(False))
         if r != 'OK':
             raise IMAPError(self.format_error('Could not revive message', data))
         return data[0]
@@ -148,8 +644,13 @@ class IMAP4(_IMAPExtension, imaplib.IMAP4): # pragma: no cover
 
     def login(self, user, password):
         self.user = user
+        self.password = password
         imaplib.IMAP4.login(self, user, password)
 
+    def reopen(self):
+        'Open a new connection to the server'
+        self.__init__(self.host, self.port)
+
     @classmethod
     def connect(cls, host='', port=None, user='', password=''):
         'Connect, login, return class instance'
@@ -176,8 +677,13 @@ class IMAP4_SSL(_IMAPExtension, imaplib.IMAP4_SSL): # pragma: no cover
 
     def login(self, user, password):
         self.user = user
+        self.password = password
         imaplib.IMAP4_SSL.login(self, user, password)
 
+    def reopen(self):
+        'Open a new connection to the server'
+        self.__init__(self.host, self.port, self.keyfile, self.certfile)
+
     @classmethod
     def connect(cls, host='', port=None, user='', password='', keyfile=None, certfile=None):
         'Connect, login, return class instance'
@@ -193,6 +699,240 @@ class IMAP4_SSL(_IMAPExtension, imaplib.IMAP4_SSL): # pragma: no cover
         return server
 
 
+class Monitor(object):
+    """
+    Aggregate the time and bytes spent on each command and on parsing.
+    Specify callback(kind, name, duration, folder, sentByteCount, receivedByteCount)
+    to forward each measurement to a metrics system such as StatsD.
+    Connections in different threads can share a Monitor.
+
+    Measure a walk.
+        server.monitor = imapIO.Monitor()
+        for email in server.walk('inbox'):
+            pass
+        for (kind, name), statistics in server.monitor.statisticsByKey.iteritems():
+            print kind, name, statistics['count'], statistics['duration']
+    """
+
+    # Upper bounds in seconds of the bins of each duration histogram
+    durationBounds = 0.001, 0.01, 0.1, 1, 10
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.statisticsByKey = {}
+        self.lock = threading.Lock()
+
+    def record(self, kind, name, duration, folder=None, sentByteCount=0, receivedByteCount=0):
+        'Record a measurement of a command or of parsing'
+        key = kind, name
+        with self.lock:
+            statistics = self.statisticsByKey.get(key)
+            if statistics is None:
+                statistics = self.statisticsByKey[key] = dict(
+                    count=0,
+                    duration=0,
+                    sentByteCount=0,
+                    receivedByteCount=0,
+                    histogram=[0] * (len(self.durationBounds) + 1))
+            statistics['count'] += 1
+            statistics['duration'] += duration
+            statistics['sentByteCount'] += sentByteCount
+            statistics['receivedByteCount'] += receivedByteCount
+            statistics['histogram'][bisect.bisect_left(self.durationBounds, duration)] += 1
+        if self.callback:
+            self.callback(kind, name, duration, folder, sentByteCount, receivedByteCount)
+
+
+class MessageBatch(object):
+    """
+    Columns of message fields from _IMAPExtension.scan().
+    Each message has a UID, a folder index, a timeStamp in seconds
+    since the epoch, a size in bytes, a sender index and a subject.
+    Folder and sender indices point into the folders and senders lists,
+    which batches from the same scan share.
+    """
+
+    # Python 2 arrays lack the typecode for long long, but long is 64-bit on most platforms
+    typeCode = 'l'
+    columnNames = 'uid', 'folder', 'timeStamp', 'size', 'sender', 'subject'
+
+    def __init__(self, folders, senders):
+        self.folders = folders
+        self.senders = senders
+        self.uids = array(self.typeCode)
+        self.folderIndices = array(self.typeCode)
+        self.timeStamps = array(self.typeCode)
+        self.sizes = array(self.typeCode)
+        self.senderIndices = array(self.typeCode)
+        self.subjects = []
+
+    def __len__(self):
+        return len(self.uids)
+
+    def as_columns(self):
+        'Return a dictionary of column values suitable for pandas.DataFrame or pyarrow.Table.from_pydict'
+        return dict(zip(self.columnNames, [
+            self.uids.tolist(),
+            [self.folders[x] for x in self.folderIndices],
+            self.timeStamps.tolist(),
+            self.sizes.tolist(),
+            [self.senders[x] for x in self.senderIndices],
+            self.subjects,
+        ]))
+
+    def as_numpy(self):
+        'Return a dictionary of numpy arrays, where folders and senders stay as indices'
+        import numpy
+        return dict(
+            uid=numpy.array(self.uids, dtype=numpy.int64),
+            folderIndex=numpy.array(self.folderIndices, dtype=numpy.int64),
+            timeStamp=numpy.array(self.timeStamps, dtype=numpy.int64),
+            size=numpy.array(self.sizes, dtype=numpy.int64),
+            senderIndex=numpy.array(self.senderIndices, dtype=numpy.int64),
+            subject=numpy.array(self.subjects, dtype=object))
+
+    def write_csv(self, targetFile, includeHeader=True):
+        'Write rows in CSV format, encoding text as utf-8'
+        writer = csv.writer(targetFile)
+        if includeHeader:
+            writer.writerow(self.columnNames)
+        for index in xrange(len(self)):
+            writer.writerow([
+                self.uids[index],
+                self.folders[self.folderIndices[index]],
+                self.timeStamps[index],
+                self.sizes[index],
+                self.senders[self.senderIndices[index]].encode('utf-8'),
+                self.subjects[index].encode('utf-8'),
+            ])
+
+
+class RateController(object):
+    """
+    Adapt the size of fetch batches and the number of connections to a host
+    by increasing them additively while the server keeps up and decreasing
+    them multiplicatively when the server throttles, fails or slows down.
+    Connections to the same host can share a RateController.
+    """
+
+    # Wait at most this many seconds between attempts
+    maximumDelay = 60
+    # Weight of the newest measurement in the moving average of time per message
+    latencyWeight = 0.2
+
+    def __init__(self, batchSize=FETCH_BATCH_SIZE, minimumBatchSize=1, maximumBatchSize=1000, batchIncrement=10,
+            connectionCount=4, maximumConnectionCount=16, decreaseFactor=0.5, latencyFactor=4):
+        """
+        Set latencyFactor to how many times slower than the moving average
+        a batch must be, per message, before we count it as a slowdown.
+        """
+        self.batchSize = batchSize
+        self.minimumBatchSize = minimumBatchSize
+        self.maximumBatchSize = maximumBatchSize
+        self.batchIncrement = batchIncrement
+        self.connectionLimit = float(connectionCount)
+        self.maximumConnectionCount = maximumConnectionCount
+        self.decreaseFactor = decreaseFactor
+        self.latencyFactor = latencyFactor
+        # Moving average of time per message since the batch size last shrank
+        self.latency = None
+        self.failureCount = 0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def for_host(cls, host):
+        'Make a RateController using the profile for the host, if there is one'
+        return cls(**RATE_PROFILE_BY_HOST.get((host or '').lower(), {}))
+
+    @property
+    def connectionCount(self):
+        'Return the number of connections that the host currently tolerates'
+        return max(1, int(self.connectionLimit))
+
+    def record_success(self, duration=None, messageCount=1):
+        'Grow limits unless the command took much longer per message than usual'
+        with self.lock:
+            self.failureCount = 0
+            if duration is not None:
+                latency = duration / max(messageCount, 1)
+                if self.latency is None:
+                    self.latency = latency
+                elif latency > self.latencyFactor * self.latency:
+                    self._decrease()
+                    return
+                else:
+                    self.latency += self.latencyWeight * (latency - self.latency)
+                self.batchSize = min(self.maximumBatchSize, self.batchSize + self.batchIncrement)
+            # Add about one connection after each round of commands on every connection
+            self.connectionLimit = min(self.maximumConnectionCount, self.connectionLimit + 1.0 / self.connectionLimit)
+
+    def record_failure(self, throttled=False):
+        'Shrink batches and, if the server throttled us, connections; wait longer after each failure'
+        with self.lock:
+            self.failureCount += 1
+            self._decrease(includeConnections=throttled)
+
+    def get_delay(self, baseDelay):
+        'Return the number of seconds to wait before trying again'
+        return min(self.maximumDelay, baseDelay * 2 ** max(self.failureCount - 1, 0))
+
+    def _decrease(self, includeConnections=True):
+        self.batchSize = max(self.minimumBatchSize, int(self.batchSize * self.decreaseFactor))
+        # Round trips weigh more on each message in smaller batches, so measure again
+        self.latency = None
+        if includeConnections:
+            self.connectionLimit = max(1.0, self.connectionLimit * self.decreaseFactor)
+
+
+class Checkpoint(object):
+    'Progress of a walk that we can save to resume the walk later'
+
+    def __init__(self, folders=(), folder=None, messageUIDs=(), uidValidityByFolder=None):
+        # Folders that the walk finished
+        self.folders = set(folders)
+        # Folder that the walk started and messages that the walk yielded from it
+        self.folder = folder
+        self.messageUIDs = set(messageUIDs)
+        # UIDVALIDITY of each folder that the walk started
+        self.uidValidityByFolder = dict(uidValidityByFolder or {})
+
+    def start(self, folder, uidValidity=None):
+        'Start walking the folder, forgetting messages from a different folder or from before the server renumbered them'
+        if folder != self.folder or uidValidity != self.uidValidityByFolder.get(folder):
+            self.folder = folder
+            self.messageUIDs = set()
+        self.uidValidityByFolder[folder] = uidValidity
+
+    def finish(self, folder):
+        'Mark the folder as finished'
+        self.folders.add(folder)
+        self.folder = None
+        self.messageUIDs = set()
+
+    def save(self, targetPath):
+        'Save progress to a file'
+        temporaryPath = targetPath + '.tmp'
+        with open(temporaryPath, 'wb') as targetFile:
+            json.dump(dict(
+                folders=sorted(self.folders),
+                folder=self.folder,
+                messageUIDs=sorted(self.messageUIDs),
+                uidValidityByFolder=self.uidValidityByFolder,
+            ), targetFile)
+        # Replace the file in one step so that a crash cannot corrupt it
+        os.rename(temporaryPath, targetPath)
+
+    @classmethod
+    def load(cls, sourcePath):
+        'Load progress from a file'
+        with open(sourcePath, 'rb') as sourceFile:
+            valueByKey = json.load(sourceFile)
+        folders = [x.encode('utf-8') for x in valueByKey['folders']]
+        folder = valueByKey['folder']
+        uidValidityByFolder = dict((x.encode('utf-8'), y) for x, y in valueByKey.get('uidValidityByFolder', {}).iteritems())
+        return cls(folders, folder.encode('utf-8') if folder is not None else None, valueByKey['messageUIDs'], uidValidityByFolder)
+
+
 class IMAPError(Exception):
     'IMAP error'
     pass
@@ -206,18 +946,20 @@ class Email(object):
         self.uid = uid
         self.folder = folder
         self.header = header
+        monitor = getattr(server, 'monitor', None)
+        if monitor is not None:
+            timeStarted = time.time()
         # Parse header
         valueByKey = HeaderParser().parsestr(header)
         def getWhom(field):
             return ', '.join(formataddr((self._decode(x), self._decode(y))) for x, y in getaddresses(valueByKey.get_all(field, [])))
         # Extract fields
         self.date = valueByKey.get('date')
-        timePack = parsedate_tz(self.date)
-        if not timePack:
+        timeStamp = parse_timeStamp(self.date)
+        if timeStamp is None:
             self.whenUTC = None
             self.whenLocal = None
         else:
-            timeStamp = timegm(timePack) if timePack[-1] is None else mktime_tz(timePack)
             self.whenUTC = datetime.datetime.utcfromtimestamp(timeStamp)
             self.whenLocal = datetime.datetime.fromtimestamp(timeStamp)
         self.subject = self._decode(valueByKey.get('subject', ''))
@@ -225,6 +967,8 @@ class Email(object):
         self.toWhom = getWhom('to')
         self.ccWhom = getWhom('cc')
         self.bccWhom = getWhom('bcc')
+        if monitor is not None:
+            monitor.record('parse', 'Email', time.time() - timeStarted, folder)
 
     def __getitem__(self, key):
         keyLower = key.lower()
@@ -241,15 +985,10 @@ class Email(object):
     def _decode(self, text):
         'Decode text into utf-8'
         try:
-            packs = decode_header(text)
+            return decode_text(text, strict=True)
         except HeaderParseError:
-            try:
-                packs = decode_header(text.replace('?==?', '?= =?'))
-            except HeaderParseError:
-                log.warn(self.format_error('Could not decode header', text))
-                packs = [(text, 'utf-8')]
-        string = ''.join(part.decode(encoding or 'utf-8', 'ignore') for part, encoding in packs)
-        return PATTERN_WHITESPACE.sub(' ', string.strip())
+            log.warn(self.format_error('Could not decode header', text))
+            return decode_text(text)
 
     def format_error(self, text, data):
         'Format an error that happened with a message'
@@ -311,7 +1050,7 @@ class Email(object):
     def as_string(self, unixfrom=False):
         'Fetch mime string from server'
         if not hasattr(self, '_string'):
-            try:
+            def load():
                 # Get
                 flags = self.flags
                 # Load message
@@ -320,10 +1059,12 @@ class Email(object):
                     raise IMAPError(self.format_error('Could not fetch body', data))
                 # Restore
                 self.flags = flags
+                return data[0][1]
+            try:
+                self._string = self.server._retry(self.folder, load)
             except imaplib.IMAP4.abort, error:
                 message = 'Connection failed while fetching body'
                 raise IMAPError(self.format_error(message, error))
-            self._string = data[0][1]
         return self._string
 
     def as_message(self):
@@ -353,16 +1094,101 @@ class Email(object):
         return partPacks
 
     def extract(self, include=lambda index, name, type: True, peek=False, applyCharset=True):
-        return extract(self.as_message(), include, peek, applyCharset)
+        monitor = getattr(self.server, 'monitor', None)
+        if monitor is None:
+            return extract(self.as_message(), include, peek, applyCharset)
+        # Fetch before we start timing so that we measure parsing only
+        self.as_string()
+        timeStarted = time.time()
+        partPacks = extract(self.as_message(), include, peek, applyCharset)
+        monitor.record('parse', 'extract', time.time() - timeStarted, self.folder)
+        return partPacks
+
+
+class StreamingMultipart(email.MIMEMultipart.MIMEMultipart):
+    """
+    Multipart message that reads large attachments from disk only when serialized.
+    Streamed attachments appear only in as_string() and _IMAPExtension.revive();
+    email.generator.Generator and get_payload() see placeholders instead.
+    """
+
+    def __init__(self, *args, **kw):
+        email.MIMEMultipart.MIMEMultipart.__init__(self, *args, **kw)
+        self.streamedPathByIndex = {}
+        # Use a random marker so that the marker does not appear in the message by chance
+        self.streamMarker = 'imapIO-stream-%x' % random.getrandbits(64)
+        self.streamPattern = re.compile(r'<%s-(\d+)>' % self.streamMarker)
+
+    def attach_stream(self, attachmentPath, mainType, subType):
+        'Attach a file that will be encoded in base64 as we serialize the message'
+        part = email.MIMEBase.MIMEBase(mainType, subType)
+        part['Content-Transfer-Encoding'] = 'base64'
+        streamIndex = len(self.streamedPathByIndex)
+        self.streamedPathByIndex[streamIndex] = attachmentPath
+        # Mark where the encoded file goes
+        part.set_payload('<%s-%s>' % (self.streamMarker, streamIndex))
+        self.attach(part)
+        return part
+
+    def as_string(self, unixfrom=False):
+        return ''.join(self.iterate_strings(unixfrom))
+
+    def iterate_strings(self, unixfrom=False, lineSeparator='\n'):
+        'Yield the serialized message in chunks'
+        text = email.MIMEMultipart.MIMEMultipart.as_string(self, unixfrom)
+        for index, piece in enumerate(self.streamPattern.split(text)):
+            # Odd pieces are indices of streamed attachments
+            if index % 2:
+                for chunk in iterate_base64(self.streamedPathByIndex[int(piece)], lineSeparator):
+                    yield chunk
+            else:
+                yield self._format_piece(piece, lineSeparator)
+
+    def get_size(self, unixfrom=False, lineSeparator='\n'):
+        'Return the length of the serialized message without reading streamed attachments'
+        text = email.MIMEMultipart.MIMEMultipart.as_string(self, unixfrom)
+        size = 0
+        for index, piece in enumerate(self.streamPattern.split(text)):
+            if index % 2:
+                encodedSize = (os.path.getsize(self.streamedPathByIndex[int(piece)]) + 2) // 3 * 4
+                lineCount = (encodedSize + 75) // 76
+                size += encodedSize + lineCount * len(lineSeparator)
+            else:
+                size += len(self._format_piece(piece, lineSeparator))
+        return size
+
+    def _format_piece(self, piece, lineSeparator):
+        # Normalize line endings the way imaplib normalizes the literal for APPEND
+        return piece if '\n' == lineSeparator else imaplib.MapCRLF.sub(lineSeparator, piece)
+
+
+class _StreamedLiteral(object):
+    'Message for APPEND that _IMAPExtension.send() writes in chunks'
+
+    def __init__(self, message):
+        self.message = message
+        self.size = message.get_size(lineSeparator='\r\n')
+
+    def __len__(self):
+        return self.size
 
+    def __iter__(self):
+        return self.message.iterate_strings(lineSeparator='\r\n')
 
-def build_message(whenUTC=None, subject='', fromWhom='', toWhom='', ccWhom='', bccWhom='', bodyText='', bodyHTML='', attachmentPaths=None):
-    'Build MIME message'
+
+def build_message(whenUTC=None, subject='', fromWhom='', toWhom='', ccWhom='', bccWhom='', bodyText='', bodyHTML='', attachmentPaths=None, stream=False):
+    """
+    Build MIME message.
+    Encoded attachments are cached, so building many messages that
+    share attachments is cheap.
+    Set stream=True to read attachments that are large and not text from disk
+    only when the message is revived; see StreamingMultipart for the caveats.
+    """
     subject, bodyText, bodyHTML = map(strip_illegal_characters, [subject, bodyText, bodyHTML])
     mimeText = email.MIMEText.MIMEText(bodyText.encode('utf-8'), _charset='utf-8')
     mimeHTML = email.MIMEText.MIMEText(bodyHTML.encode('utf-8'), 'html')
     if attachmentPaths:
-        message = email.MIMEMultipart.MIMEMultipart()
+        message = StreamingMultipart() if stream else email.MIMEMultipart.MIMEMultipart()
         if bodyText and bodyHTML:
             messageAlternative = email.MIMEMultipart.MIMEMultipart('alternative')
             messageAlternative.attach(mimeText)
@@ -379,19 +1205,29 @@ def build_message(whenUTC=None, subject='', fromWhom='', toWhom='', ccWhom='', b
             if contentType is None or contentEncoding is not None:
                 contentType = 'application/octet-stream'
             mainType, subType = contentType.split('/', 1)
-            payload = open(attachmentPath, 'rb').read()
-            if mainType == 'text':
-                part = email.MIMEText.MIMEText(payload, _subtype=subType, _charset=chardet.detect(payload)['encoding'])
-            elif mainType == 'image':
-                part = email.MIMEImage.MIMEImage(payload, _subtype=subType)
-            elif mainType == 'audio':
-                part = email.MIMEAudio.MIMEAudio(payload, _subtype=subType)
-            else:
-                part = email.MIMEBase.MIMEBase(mainType, subType)
-                part.set_payload(payload)
-                email.Encoders.encode_base64(part)
-            part.add_header('Content-Disposition', 'attachment', filename=attachmentName)
-            message.attach(part)
+            attachmentStat = os.stat(attachmentPath)
+            if stream and mainType != 'text' and attachmentStat.st_size >= ATTACHMENT_STREAM_SIZE:
+                part = message.attach_stream(attachmentPath, mainType, subType)
+                part.add_header('Content-Disposition', 'attachment', filename=attachmentName)
+                continue
+            key = attachmentPath, attachmentStat.st_mtime, attachmentStat.st_size, contentType
+            part = attachmentCache.get(key)
+            if part is None:
+                payload = open(attachmentPath, 'rb').read()
+                if mainType == 'text':
+                    part = email.MIMEText.MIMEText(payload, _subtype=subType, _charset=detect_charset(payload))
+                elif mainType == 'image':
+                    part = email.MIMEImage.MIMEImage(payload, _subtype=subType)
+                elif mainType == 'audio':
+                    part = email.MIMEAudio.MIMEAudio(payload, _subtype=subType)
+                else:
+                    part = email.MIMEBase.MIMEBase(mainType, subType)
+                    part.set_payload(payload)
+                    email.Encoders.encode_base64(part)
+                part.add_header('Content-Disposition', 'attachment', filename=attachmentName)
+                attachmentCache.set(key, part, len(part.get_payload()))
+            # Copy headers so that changes to one message do not affect another; payload strings are shared
+            message.attach(copy.deepcopy(part))
     elif bodyText and bodyHTML:
         message = email.MIMEMultipart.MIMEMultipart('alternative')
         message.attach(mimeText)
@@ -441,13 +1277,257 @@ def extract(source, include=lambda index, name, type: True, peek=False, applyCha
         if not peek:
             payload = part.get_payload(decode=True) or ''
             if 'text' == mainType and applyCharset:
-                charset = part.get_content_charset() or part.get_charset() or chardet.detect(payload)['encoding']
+                charset = part.get_content_charset() or part.get_charset() or detect_charset(payload)
                 payload = payload.decode(charset, 'ignore')
             partPack += (payload,)
         partPacks.append(partPack)
     return partPacks
 
 
+def iterate_base64(sourcePath, lineSeparator='\n'):
+    'Yield the contents of a file encoded in base64 in lines of 76 characters'
+    with open(sourcePath, 'rb') as sourceFile:
+        while True:
+            chunk = sourceFile.read(ATTACHMENT_CHUNK_SIZE)
+            if not chunk:
+                break
+            text = base64.b64encode(chunk)
+            yield ''.join(text[x:x + 76] + lineSeparator for x in xrange(0, len(text), 76))
+
+
+def detect_charset(payload):
+    'Guess the charset of text from a sample'
+    return chardet.detect(payload[:CHARDET_SAMPLE_SIZE])['encoding']
+
+
+def decode_text(text, strict=False):
+    'Decode header text into unicode, leaving text that we cannot parse as is unless strict=True'
+    # Skip decode_header for text without encoded words, which is most text
+    if '=?' not in text:
+        return PATTERN_WHITESPACE.sub(' ', text.decode('utf-8', 'ignore').strip())
+    try:
+        packs = decode_header(text)
+    except HeaderParseError:
+        try:
+            packs = decode_header(text.replace('?==?', '?= =?'))
+        except HeaderParseError:
+            if strict:
+                raise
+            packs = [(text, 'utf-8')]
+    string = ''.join(part.decode(encoding or 'utf-8', 'ignore') for part, encoding in packs)
+    return PATTERN_WHITESPACE.sub(' ', string.strip())
+
+
+def format_whom(values):
+    'Decode and format addresses from header values'
+    return ', '.join(formataddr((decode_text(x), decode_text(y))) for x, y in getaddresses(values))
+
+
+def parse_headerFields(header):
+    'Return unfolded header values by lowercase field name, keeping the first value of each field'
+    valueByKey, key = {}, None
+    for line in header.splitlines():
+        # Continuation lines belong to the previous field
+        if line[:1] in (' ', '\t'):
+            if key is not None:
+                valueByKey[key] += ' ' + line.strip()
+            continue
+        # A blank line ends the header
+        if not line.strip():
+            break
+        key, colon, value = line.partition(':')
+        key = key.strip().lower() if colon else None
+        if key is None or key in valueByKey:
+            key = None
+            continue
+        valueByKey[key] = value.strip()
+    return valueByKey
+
+
+def parse_timeStamp(date):
+    'Convert the value of a Date header into seconds since the epoch'
+    timePack = parsedate_tz(date) if date else None
+    if not timePack:
+        return
+    return timegm(timePack) if timePack[-1] is None else mktime_tz(timePack)
+
+
+def is_throttled(data):
+    'Return True if the server response says that we are sending too much'
+    return PATTERN_THROTTLED.search(str(data)) is not None
+
+
+def format_messageSets(messageUIDs):
+    'Yield comma-separated messageUIDs in batches'
+    for index in xrange(0, len(messageUIDs), FETCH_BATCH_SIZE):
+        yield ','.join(str(x) for x in messageUIDs[index:index + FETCH_BATCH_SIZE])
+
+
+def split_by_size(values, sizes, maximumSize):
+    'Yield lists of values whose sizes add up to at most maximumSize, except that a list always has at least one value'
+    batch, batchSize = [], 0
+    for value, size in zip(values, sizes):
+        if batch and batchSize + size > maximumSize:
+            yield batch
+            batch, batchSize = [], 0
+        batch.append(value)
+        batchSize += size
+    if batch:
+        yield batch
+
+
+def parse_fetch(data):
+    'Parse a FETCH response into (messageUID, attributes, literal) for each message'
+    fetchPacks = []
+    for item in data:
+        if isinstance(item, tuple):
+            attributes, literal = item
+            if fetchPacks and not PATTERN_FETCH.match(attributes):
+                messageUID, previousAttributes, previousLiteral = fetchPacks[-1]
+                fetchPacks[-1] = messageUID, previousAttributes + attributes, previousLiteral or literal
+                continue
+        elif item and PATTERN_FETCH.match(item):
+            attributes, literal = item, None
+        else:
+            if item and fetchPacks:
+                messageUID, attributes, literal = fetchPacks[-1]
+                fetchPacks[-1] = messageUID, attributes + item, literal
+            continue
+        fetchPacks.append((None, attributes, literal))
+    for messageUID, attributes, literal in fetchPacks:
+        match = PATTERN_UID.search(attributes)
+        if not match:
+            continue
+        yield int(match.group(1)), attributes, literal
+
+
+def parse_threads(text):
+    'Parse a THREAD response into a list of (messageUID, childPacks) tuples'
+    threadPacks = []
+    # Keep (messageUIDs, childPacks) for each open list instead of recursing so that deep threads do not exhaust the stack
+    stack = []
+    for token in PATTERN_THREAD.findall(text):
+        if token == '(':
+            stack.append(([], []))
+        elif token == ')':
+            messageUIDs, childPacks = stack.pop()
+            # A list without messages is a thread whose root is missing
+            if not messageUIDs:
+                threadPack = None, childPacks
+            # Members of a list form a chain of replies
+            else:
+                threadPack = messageUIDs.pop(), childPacks
+                for messageUID in reversed(messageUIDs):
+                    threadPack = messageUID, [threadPack]
+            (stack[-1][1] if stack else threadPacks).append(threadPack)
+        else:
+            stack[-1][0].append(int(token))
+    return threadPacks
+
+
+def walk_threads(threadPacks):
+    'Yield every value in the thread tree'
+    stack = list(threadPacks)
+    while stack:
+        value, childPacks = stack.pop()
+        if value is not None:
+            yield value
+        stack.extend(childPacks)
+
+
+def map_threads(function, threadPacks):
+    'Return a copy of the thread tree with the function applied to every value'
+    results = []
+    stack = [(threadPacks, results)]
+    while stack:
+        sourcePacks, targetPacks = stack.pop()
+        for value, childPacks in sourcePacks:
+            targetChildPacks = []
+            targetPacks.append((function(value), targetChildPacks))
+            stack.append((childPacks, targetChildPacks))
+    return results
+
+
+class _ThreadContainer(object):
+    'Node in a thread tree built with the algorithm by Jamie Zawinski'
+
+    def __init__(self):
+        self.email = None
+        self.parent = None
+        self.children = []
+
+    def has_ancestor(self, container):
+        x = self
+        while x is not None:
+            if x is container:
+                return True
+            x = x.parent
+        return False
+
+    def pack(self):
+        'Return (key, threadPack) tuples to attach to the parent, where key orders threads by their earliest message'
+        keyPacksByContainer = {}
+        # Pack children before their parents without recursing so that long reply chains do not exhaust the stack
+        stack = [(self, False)]
+        while stack:
+            container, childrenPacked = stack.pop()
+            if not childrenPacked:
+                stack.append((container, True))
+                stack.extend((x, False) for x in container.children)
+                continue
+            keyPacks = sorted((y for x in container.children for y in keyPacksByContainer.pop(x)), key=lambda x: x[0])
+            keys = [key for key, threadPack in keyPacks]
+            if container.email is not None:
+                keys.append((container.email.whenUTC, container.email.uid))
+            # Promote the children of containers that are missing a message
+            elif len(keyPacks) < 2:
+                keyPacksByContainer[container] = keyPacks
+                continue
+            keyPacksByContainer[container] = [(min(keys), (container.email, [threadPack for key, threadPack in keyPacks]))]
+        return keyPacksByContainer[self]
+
+
+def thread_emails(emails):
+    'Group emails into threads using Message-ID, In-Reply-To and References'
+    containerByID = {}
+    def get_container(messageID):
+        if messageID not in containerByID:
+            containerByID[messageID] = _ThreadContainer()
+        return containerByID[messageID]
+    def link(parent, child):
+        # Do not create loops
+        if child.parent is not None or parent.has_ancestor(child):
+            return
+        child.parent = parent
+        parent.children.append(child)
+    for email in emails:
+        valueByKey = HeaderParser().parsestr(email.header)
+        messageIDs = PATTERN_MESSAGE_ID.findall(valueByKey.get('message-id', ''))
+        messageID = messageIDs[0] if messageIDs else '<%s@%s>' % (email.uid, email.folder)
+        container = get_container(messageID)
+        # If the Message-ID is a duplicate, give the message its own container
+        if container.email is not None:
+            messageID = '<%s@%s>' % (email.uid, email.folder)
+            container = get_container(messageID)
+        container.email = email
+        references = PATTERN_MESSAGE_ID.findall(valueByKey.get('references', ''))
+        inReplyTo = PATTERN_MESSAGE_ID.findall(valueByKey.get('in-reply-to', ''))
+        if inReplyTo and inReplyTo[0] not in references:
+            references.append(inReplyTo[0])
+        references = [x for x in references if x != messageID]
+        for parentID, childID in zip(references, references[1:]):
+            link(get_container(parentID), get_container(childID))
+        if references:
+            parent = get_container(references[-1])
+            # Trust the message over links guessed from other messages
+            if container.parent is not None and container.parent is not parent:
+                container.parent.children.remove(container)
+                container.parent = None
+            link(parent, container)
+    keyPacks = sorted((y for x in containerByID.itervalues() if x.parent is None for y in x.pack()), key=lambda x: x[0])
+    return [threadPack for key, threadPack in keyPacks]
+
+
 def make_folderFilter(x):
     # If x is unicode or a string,
     if hasattr(x, 'lower'):
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark imapIO against a FakeIMAPServer seeded with synthetic mailboxes.
+Each benchmark runs in a separate process so that its peak memory is its own.
+
+Compare throughput of the current checkout with a previous version.
+    python -m imapIO.benchmarks --messageCount 1000 --latency 0.001
+"""
+import argparse
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+
+import imapIO
+from imapIO.fake_server import FakeIMAPServer, seed_mailboxes
+
+
+USER = 'user'
+PASSWORD = 'password'
+
+
+def benchmark_walk(server, arguments):
+    return sum(1 for email in server.walk())
+
+
+def benchmark_scan(server, arguments):
+    return sum(len(batch) for batch in server.scan())
+
+
+def benchmark_as_string(server, arguments):
+    return sum(1 for email in server.walk() if email.as_string())
+
+
+def benchmark_save(server, arguments):
+    targetPath = tempfile.mkstemp(suffix='.gz')[1]
+    try:
+        return sum(1 for email in server.walk() if email.save(targetPath) is not None)
+    finally:
+        os.remove(targetPath)
+
+
+def benchmark_extract(server, arguments):
+    return sum(1 for email in server.walk() if email.extract() is not None)
+
+
+def benchmark_revive(server, arguments):
+    messageCount = 0
+    for email in list(server.walk('inbox')):
+        server.revive('revived', email)
+        messageCount += 1
+    return messageCount
+
+
+def benchmark_codec(server, arguments):
+    folders = [u'Inbox', u'Sent & Archived', u'Спасибо', u'受信箱/2005']
+    iterationCount = arguments.messageCount * 10
+    for index in xrange(iterationCount):
+        folder = folders[index % len(folders)]
+        assert folder.encode('utf-7-imap4').decode('utf-7-imap4') == folder
+    return iterationCount
+
+
+BENCHMARK_BY_NAME = {
+    'walk': benchmark_walk,
+    'scan': benchmark_scan,
+    'as_string': benchmark_as_string,
+    'save': benchmark_save,
+    'extract': benchmark_extract,
+    'revive': benchmark_revive,
+    'codec': benchmark_codec,
+}
+BENCHMARK_NAMES = 'walk', 'scan', 'as_string', 'save', 'extract', 'revive', 'codec'
+
+
+def run(benchmarkName, arguments):
+    'Run the benchmark in a separate process and return (count, seconds, peakByteCount)'
+    fakeServer = FakeIMAPServer(latency=arguments.latency, bandwidth=arguments.bandwidth)
+    fakeServer.add_account(USER, PASSWORD)
+    seed_mailboxes(fakeServer, USER,
+        folderCount=arguments.folderCount,
+        messageCount=arguments.messageCount,
+        bodySize=arguments.bodySize,
+        attachmentSize=arguments.attachmentSize,
+        seed=arguments.seed)
+    fakeServer.start()
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=measure, args=(queue, benchmarkName, fakeServer.server_address, arguments))
+    try:
+        process.start()
+        result = queue.get()
+        process.join()
+    finally:
+        fakeServer.stop()
+    return result
+
+
+def measure(queue, benchmarkName, address, arguments):
+    host, port = address
+    server = imapIO.IMAP4.connect(host, port, USER, PASSWORD)
+    # Seed the random number generator so that walks visit messages in the same order
+    imapIO.random.seed(arguments.seed)
+    byteCountStarted = get_peakByteCount()
+    timeStarted = time.time()
+    count = BENCHMARK_BY_NAME[benchmarkName](server, arguments)
+    seconds = time.time() - timeStarted
+    queue.put((count, seconds, get_peakByteCount() - byteCountStarted))
+    server.logout()
+
+
+def get_peakByteCount():
+    'Return peak resident memory of this process in bytes'
+    peakSize = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes and Mac OS X reports bytes
+    return peakSize if 'darwin' == sys.platform else peakSize * 1024
+
+
+def parse_arguments(args=None):
+    argumentParser = argparse.ArgumentParser(description='Benchmark imapIO against a fake IMAP server')
+    argumentParser.add_argument('benchmarkNames', nargs='*', metavar='benchmark', help=', '.join(BENCHMARK_NAMES))
+    argumentParser.add_argument('--messageCount', type=int, default=300)
+    argumentParser.add_argument('--folderCount', type=int, default=3)
+    argumentParser.add_argument('--bodySize', type=int, default=2000, help='bytes of text in each body')
+    argumentParser.add_argument('--attachmentSize', type=int, default=0, help='bytes in an attachment on each message')
+    argumentParser.add_argument('--latency', type=float, default=0, help='seconds before each server response')
+    argumentParser.add_argument('--bandwidth', type=int, default=None, help='bytes per second that the server sends')
+    argumentParser.add_argument('--seed', type=int, default=0)
+    arguments = argumentParser.parse_args(args)
+    for benchmarkName in arguments.benchmarkNames:
+        if benchmarkName not in BENCHMARK_BY_NAME:
+            argumentParser.error('unknown benchmark: %s' % benchmarkName)
+    return arguments
+
+
+def main(args=None):
+    arguments = parse_arguments(args)
+    print '%-10s %10s %10s %12s %14s' % ('benchmark', 'count', 'seconds', 'per second', 'peak bytes')
+    for benchmarkName in arguments.benchmarkNames or BENCHMARK_NAMES:
+        count, seconds, peakByteCount = run(benchmarkName, arguments)
+        print '%-10s %10d %10.3f %12.1f %14d' % (benchmarkName, count, seconds, count / seconds if seconds else 0, peakByteCount)
+
+
+if __name__ == '__main__':
+    main()
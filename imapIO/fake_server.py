@@ -0,0 +1,600 @@
+"""
+In-process IMAP server for tests and benchmarks that need no real account.
+It keeps mailboxes in memory and supports the subset of IMAP4rev1
+that imapIO uses: LIST, SELECT, STATUS, CREATE, APPEND, EXPUNGE and
+UID SEARCH, SORT, FETCH, STORE, COPY, MOVE.
+Inject latency and bandwidth limits to imitate a remote server.
+
+Walk a synthetic mailbox.
+    server = FakeIMAPServer(latency=0.01)
+    server.add_account('user', 'password')
+    seed_mailboxes(server, 'user', folderCount=3, messageCount=100)
+    server.start()
+    host, port = server.server_address
+    for email in imapIO.IMAP4.connect(host, port, 'user', 'password').walk():
+        print email.subject
+    server.stop()
+"""
+import SocketServer
+import calendar
+import datetime
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+from email.parser import HeaderParser
+from email.utils import mktime_tz, parsedate_tz, getaddresses
+
+import imapIO
+
+
+CAPABILITIES = 'IMAP4rev1 SORT MOVE UIDPLUS'
+MONTHS = 'JAN FEB MAR APR MAY JUN JUL AUG SEP OCT NOV DEC'.split()
+PATTERN_LITERAL = re.compile(r'\{(\d+)\}\r?\n?$')
+PATTERN_TOKEN = re.compile(r'\(|\)|"(?:[^"\\]|\\.)*"|[^\s()"\[]+(?:\[[^\]]*\][^\s()"]*)?')
+PATTERN_SECTION = re.compile(r'(?P<name>BODY(?:\.PEEK)?|BINARY(?:\.PEEK)?)\[(?P<section>[^\]]*)\]', re.I)
+PATTERN_MUSTQUOTE = re.compile(r'[^\w!#$%&\'*+,.:;<=>?^`|~-]')
+PATTERN_HEADER_END = re.compile(r'\r?\n\r?\n')
+WORDS = 'alpha bravo charlie delta echo foxtrot golf hotel india juliet kilo lima mike november oscar papa quebec romeo sierra tango uniform victor whiskey xray yankee zulu'.split()
+
+
+class FakeIMAPServer(SocketServer.ThreadingTCPServer):
+    'IMAP server that keeps mailboxes in memory'
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0, bandwidth=None):
+        """
+        Set latency to the number of seconds to wait before each tagged response.
+        Set bandwidth to the number of bytes per second to send.
+        """
+        SocketServer.ThreadingTCPServer.__init__(self, (host, port), FakeIMAPHandler)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.passwordByUser = {}
+        self.mailboxesByUser = {}
+        self.lock = threading.RLock()
+        self.thread = None
+
+    def add_account(self, user, password, folders=('INBOX',)):
+        'Add an account with the given folders and return its mailboxes by name'
+        self.passwordByUser[user] = password
+        mailboxByName = self.mailboxesByUser.setdefault(user, {})
+        for folder in folders:
+            mailboxByName.setdefault(folder, Mailbox(folder))
+        return mailboxByName
+
+    def start(self):
+        'Serve requests in a background thread'
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        'Stop serving requests'
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
+
+
+class Mailbox(object):
+    'Folder of messages in a FakeIMAPServer'
+
+    def __init__(self, name, uidValidity=1, selectable=True):
+        """
+        Set selectable=False for a folder that only holds other folders,
+        such as [Gmail], which servers flag as \\Noselect.
+        """
+        self.name = name
+        self.uidValidity = uidValidity
+        self.selectable = selectable
+        self.uidNext = 1
+        self.messages = []
+
+    def add(self, string, flags=(), internalDate=None):
+        'Add a message and return its UID'
+        message = Message(self.uidNext, string, flags, time.time() if internalDate is None else internalDate)
+        self.messages.append(message)
+        self.uidNext += 1
+        return message.uid
+
+
+class Message(object):
+    'Message in a Mailbox'
+
+    def __init__(self, uid, string, flags, internalDate):
+        self.uid = uid
+        self.string = string
+        self.flags = set(flags)
+        self.internalDate = internalDate
+
+    def get_header(self):
+        match = PATTERN_HEADER_END.search(self.string)
+        return self.string[:match.end()] if match else self.string
+
+    def get_text(self):
+        match = PATTERN_HEADER_END.search(self.string)
+        return self.string[match.end():] if match else ''
+
+    def get_header_fields(self, fields, exclude=False):
+        'Return header lines whose field names are (or are not) in fields'
+        fields = set(x.upper() for x in fields)
+        lines, include = [], False
+        for line in self.get_header().splitlines(True):
+            if not line.strip():
+                continue
+            # Continuation lines belong to the previous field
+            if line[0] not in ' \t':
+                include = (line.split(':', 1)[0].strip().upper() in fields) != exclude
+            if include:
+                lines.append(line)
+        return ''.join(lines) + '\r\n'
+
+    def get_valueByKey(self):
+        if not hasattr(self, '_valueByKey'):
+            self._valueByKey = HeaderParser().parsestr(self.get_header())
+        return self._valueByKey
+
+    def get_sentDate(self):
+        timePack = parsedate_tz(self.get_valueByKey().get('date', ''))
+        if not timePack:
+            return self.internalDate
+        return calendar.timegm(timePack) if timePack[-1] is None else mktime_tz(timePack)
+
+
+class FakeIMAPHandler(SocketServer.StreamRequestHandler):
+    'Connection to a FakeIMAPServer'
+
+    def handle(self):
+        self.user = None
+        self.mailbox = None
+        self.send('* OK [CAPABILITY %s] Fake IMAP server ready\r\n' % CAPABILITIES)
+        while True:
+            arguments = self.receive()
+            if arguments is None or len(arguments) < 2:
+                break
+            tag, command, arguments = arguments[0], arguments[1].upper(), arguments[2:]
+            self.responses = []
+            # Hold the lock while we change mailboxes but not while we send
+            with self.server.lock:
+                try:
+                    status, text = self.run(command, arguments)
+                except Exception, error:
+                    status, text = 'BAD', '%s failed: %s' % (command, error)
+            if self.server.latency:
+                time.sleep(self.server.latency)
+            self.responses.append('%s %s %s\r\n' % (tag, status, text))
+            self.send(''.join(self.responses))
+            if 'LOGOUT' == command:
+                break
+
+    def receive(self):
+        'Read a command, including its literals, and return its parsed arguments'
+        tokens = []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            match = PATTERN_LITERAL.search(line)
+            tokens.extend(tokenize(line[:match.start()] if match else line))
+            if not match:
+                return nest(tokens)
+            self.send('+ Ready for literal\r\n')
+            tokens.append(('string', self.rfile.read(int(match.group(1)))))
+
+    def respond(self, data):
+        'Queue an untagged response'
+        self.responses.append(data)
+
+    def send(self, data):
+        bandwidth = self.server.bandwidth
+        if bandwidth:
+            time.sleep(len(data) / float(bandwidth))
+        self.wfile.write(data)
+
+    def run(self, command, arguments):
+        if 'CAPABILITY' == command:
+            self.respond('* CAPABILITY %s\r\n' % CAPABILITIES)
+        elif 'NOOP' == command or 'CHECK' == command:
+            pass
+        elif 'LOGOUT' == command:
+            self.respond('* BYE Fake IMAP server logging out\r\n')
+        elif 'LOGIN' == command:
+            user, password = arguments
+            if user not in self.server.passwordByUser or self.server.passwordByUser[user] != password:
+                return 'NO', '[AUTHENTICATIONFAILED] Invalid credentials'
+            self.user = user
+        elif self.user is None:
+            return 'BAD', 'Please login first'
+        elif 'LIST' == command or 'LSUB' == command:
+            for name, mailbox in sorted(self.mailboxByName.iteritems()):
+                flags = '\\HasNoChildren' if mailbox.selectable else '\\Noselect \\HasChildren'
+                self.respond('* %s (%s) "/" %s\r\n' % (command, flags, quote(name)))
+        elif command in ('SELECT', 'EXAMINE'):
+            mailbox = self.find_mailbox(arguments[0])
+            if mailbox is None:
+                self.mailbox = None
+                return 'NO', 'Mailbox does not exist'
+            if not mailbox.selectable:
+                self.mailbox = None
+                return 'NO', '[CANNOT] Mailbox is not selectable'
+            self.mailbox = mailbox
+            self.respond('* FLAGS (\\Answered \\Flagged \\Deleted \\Seen \\Draft)\r\n')
+            self.respond('* %s EXISTS\r\n* 0 RECENT\r\n' % len(mailbox.messages))
+            self.respond('* OK [UIDVALIDITY %s] UIDs valid\r\n' % mailbox.uidValidity)
+            self.respond('* OK [UIDNEXT %s] Predicted next UID\r\n' % mailbox.uidNext)
+            return 'OK', '[READ-WRITE] %s completed' % command
+        elif 'STATUS' == command:
+            mailbox = self.find_mailbox(arguments[0])
+            if mailbox is None:
+                return 'NO', 'Mailbox does not exist'
+            if not mailbox.selectable:
+                return 'NO', '[CANNOT] Mailbox is not selectable'
+            valueByKey = {
+                'MESSAGES': len(mailbox.messages),
+                'RECENT': 0,
+                'UIDNEXT': mailbox.uidNext,
+                'UIDVALIDITY': mailbox.uidValidity,
+                'UNSEEN': sum(1 for x in mailbox.messages if '\\Seen' not in x.flags),
+            }
+            items = ' '.join('%s %s' % (x.upper(), valueByKey[x.upper()]) for x in arguments[1])
+            self.respond('* STATUS %s (%s)\r\n' % (quote(mailbox.name), items))
+        elif 'CREATE' == command:
+            if self.find_mailbox(arguments[0]) is not None:
+                return 'NO', 'Mailbox exists'
+            self.mailboxByName[arguments[0]] = Mailbox(arguments[0])
+        elif 'APPEND' == command:
+            mailbox = self.find_mailbox(arguments[0])
+            if mailbox is None:
+                return 'NO', '[TRYCREATE] Mailbox does not exist'
+            flags, internalDate = [], None
+            for argument in arguments[1:-1]:
+                if isinstance(argument, list):
+                    flags = argument
+                else:
+                    internalDate = parse_internalDate(argument)
+            uid = mailbox.add(arguments[-1], flags, internalDate)
+            return 'OK', '[APPENDUID %s %s] APPEND completed' % (mailbox.uidValidity, uid)
+        elif self.mailbox is None:
+            return 'BAD', 'Please select a mailbox first'
+        elif 'EXPUNGE' == command or 'CLOSE' == command:
+            self.expunge(quiet='CLOSE' == command)
+            if 'CLOSE' == command:
+                self.mailbox = None
+        elif 'UID' == command:
+            return self.run_uid(arguments[0].upper(), arguments[1:])
+        else:
+            return 'BAD', 'Unsupported command %s' % command
+        return 'OK', '%s completed' % command
+
+    def run_uid(self, command, arguments):
+        messages = self.mailbox.messages
+        if 'SEARCH' == command:
+            matches = search(messages, strip_charset(arguments))
+            self.respond('* SEARCH %s\r\n' % ' '.join(str(x.uid) for x in matches))
+        elif 'SORT' == command:
+            sortKeys, searchKeys = arguments[0], arguments[2:]
+            matches = sort(search(messages, searchKeys), sortKeys)
+            self.respond('* SORT %s\r\n' % ' '.join(str(x.uid) for x in matches))
+        elif 'FETCH' == command:
+            items = arguments[1] if isinstance(arguments[1], list) else [arguments[1]]
+            for index, message in self.select_messages(arguments[0]):
+                self.respond('* %s FETCH (%s)\r\n' % (index + 1, self.format_fetch(message, items)))
+        elif 'STORE' == command:
+            operator, flags = arguments[1].upper(), arguments[2]
+            flags = set(flags if isinstance(flags, list) else [flags])
+            for index, message in self.select_messages(arguments[0]):
+                if operator.startswith('+'):
+                    message.flags.update(flags)
+                elif operator.startswith('-'):
+                    message.flags.difference_update(flags)
+                else:
+                    message.flags = set(flags)
+                if not operator.endswith('.SILENT'):
+                    self.respond('* %s FETCH (UID %s FLAGS (%s))\r\n' % (index + 1, message.uid, ' '.join(sorted(message.flags))))
+        elif command in ('COPY', 'MOVE'):
+            mailbox = self.find_mailbox(arguments[1])
+            if mailbox is None:
+                return 'NO', '[TRYCREATE] Mailbox does not exist'
+            indexMessages = self.select_messages(arguments[0])
+            for index, message in indexMessages:
+                mailbox.add(message.string, message.flags.difference(['\\Recent']), message.internalDate)
+            if 'MOVE' == command:
+                for index, message in reversed(indexMessages):
+                    messages.pop(index)
+                    self.respond('* %s EXPUNGE\r\n' % (index + 1))
+        else:
+            return 'BAD', 'Unsupported command UID %s' % command
+        return 'OK', 'UID %s completed' % command
+
+    @property
+    def mailboxByName(self):
+        return self.server.mailboxesByUser[self.user]
+
+    def find_mailbox(self, name):
+        name = name.lower()
+        for mailbox in self.mailboxByName.itervalues():
+            if mailbox.name.lower() == name:
+                return mailbox
+
+    def select_messages(self, messageSet):
+        'Return (index, message) in folder order for messages whose UIDs are in the messageSet'
+        messages = self.mailbox.messages
+        indices = set()
+        # Look up each range with a binary search so that the cost depends on the size of the messageSet, not the folder
+        for first, last in parse_messageSet(messageSet, messages[-1].uid if messages else 0):
+            index = find_index(messages, first)
+            while index < len(messages) and messages[index].uid <= last:
+                indices.add(index)
+                index += 1
+        return [(index, messages[index]) for index in sorted(indices)]
+
+    def format_fetch(self, message, items):
+        parts = ['UID %s' % message.uid]
+        for item in items:
+            item = item.upper() if isinstance(item, basestring) else item
+            if item in ('UID', 'ALL', 'FAST', 'FULL'):
+                continue
+            if 'FLAGS' == item:
+                parts.append('FLAGS (%s)' % ' '.join(sorted(message.flags)))
+            elif 'RFC822.SIZE' == item:
+                parts.append('RFC822.SIZE %s' % len(message.string))
+            elif 'INTERNALDATE' == item:
+                parts.append('INTERNALDATE %s' % format_internalDate(message.internalDate))
+            elif item in ('RFC822', 'RFC822.HEADER', 'RFC822.TEXT'):
+                string = {
+                    'RFC822': message.string,
+                    'RFC822.HEADER': message.get_header(),
+                    'RFC822.TEXT': message.get_text(),
+                }[item]
+                parts.append('%s {%s}\r\n%s' % (item, len(string), string))
+                if 'RFC822.HEADER' != item:
+                    message.flags.add('\\Seen')
+            else:
+                match = PATTERN_SECTION.match(item)
+                if not match:
+                    raise ValueError('Unsupported fetch item %s' % item)
+                section = match.group('section')
+                sectionName = section.split(' ', 1)[0]
+                if not section:
+                    string = message.string
+                elif 'HEADER' == sectionName:
+                    string = message.get_header()
+                elif 'TEXT' == sectionName:
+                    string = message.get_text()
+                elif sectionName in ('HEADER.FIELDS', 'HEADER.FIELDS.NOT'):
+                    fields = section[section.index('(') + 1:section.rindex(')')].split()
+                    string = message.get_header_fields(fields, exclude=sectionName.endswith('.NOT'))
+                else:
+                    raise ValueError('Unsupported section %s' % section)
+                parts.append('BODY[%s] {%s}\r\n%s' % (section, len(string), string))
+                if '.PEEK' not in match.group('name').upper():
+                    message.flags.add('\\Seen')
+        return ' '.join(parts)
+
+    def expunge(self, quiet=False):
+        messages = self.mailbox.messages
+        for index in reversed(xrange(len(messages))):
+            if '\\Deleted' in messages[index].flags:
+                messages.pop(index)
+                if not quiet:
+                    self.respond('* %s EXPUNGE\r\n' % (index + 1))
+
+
+def tokenize(text):
+    'Split a line into tokens'
+    tokens = []
+    for token in PATTERN_TOKEN.findall(text):
+        if token in '()':
+            tokens.append((token, token))
+        elif token.startswith('"'):
+            tokens.append(('string', re.sub(r'\\(.)', r'\1', token[1:-1])))
+        else:
+            tokens.append(('string', token))
+    return tokens
+
+
+def nest(tokens):
+    'Convert tokens into strings and nested lists of strings'
+    stack = [[]]
+    for kind, value in tokens:
+        if '(' == kind:
+            stack.append([])
+        elif ')' == kind:
+            items = stack.pop()
+            stack[-1].append(items)
+        else:
+            stack[-1].append(value)
+    return stack[0]
+
+
+def quote(text):
+    if text and not PATTERN_MUSTQUOTE.search(text):
+        return text
+    return '"%s"' % text.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def strip_charset(arguments):
+    if arguments and isinstance(arguments[0], basestring) and arguments[0].upper() == 'CHARSET':
+        return arguments[2:]
+    return arguments
+
+
+def search(messages, keys):
+    'Return messages that match all search keys'
+    return [x for x in messages if match_keys(x, keys)]
+
+
+def match_keys(message, keys):
+    queue = list(keys)
+    while queue:
+        if not match_key(message, queue):
+            return False
+    return True
+
+
+def match_key(message, queue):
+    'Pop a search key and its arguments from the queue and return True if the message matches'
+    key = queue.pop(0)
+    if isinstance(key, list):
+        return match_keys(message, key)
+    key = key.upper()
+    flagByKey = {
+        'ANSWERED': '\\Answered',
+        'DELETED': '\\Deleted',
+        'DRAFT': '\\Draft',
+        'FLAGGED': '\\Flagged',
+        'SEEN': '\\Seen',
+    }
+    if 'ALL' == key:
+        return True
+    if key in flagByKey:
+        return flagByKey[key] in message.flags
+    if key.startswith('UN') and key[2:] in flagByKey:
+        return flagByKey[key[2:]] not in message.flags
+    if 'NOT' == key:
+        return not match_key(message, queue)
+    if 'OR' == key:
+        x = match_key(message, queue)
+        y = match_key(message, queue)
+        return x or y
+    if key in ('BEFORE', 'ON', 'SINCE', 'SENTBEFORE', 'SENTON', 'SENTSINCE'):
+        day = parse_searchDate(queue.pop(0))
+        timeStamp = message.get_sentDate() if key.startswith('SENT') else message.internalDate
+        messageDay = datetime.datetime.utcfromtimestamp(timeStamp).date()
+        if key.endswith('BEFORE'):
+            return messageDay < day
+        if key.endswith('ON'):
+            return messageDay == day
+        return messageDay >= day
+    if key in ('LARGER', 'SMALLER'):
+        size = int(queue.pop(0))
+        return len(message.string) > size if 'LARGER' == key else len(message.string) < size
+    if key in ('BCC', 'CC', 'FROM', 'SUBJECT', 'TO'):
+        return queue.pop(0).lower() in ' '.join(message.get_valueByKey().get_all(key, [])).lower()
+    if 'HEADER' == key:
+        field, text = queue.pop(0), queue.pop(0)
+        return text.lower() in ' '.join(message.get_valueByKey().get_all(field, [])).lower()
+    if 'BODY' == key:
+        return queue.pop(0).lower() in message.get_text().lower()
+    if 'TEXT' == key:
+        return queue.pop(0).lower() in message.string.lower()
+    if 'UID' == key:
+        return any(x <= message.uid <= y for x, y in parse_messageSet(queue.pop(0), message.uid))
+    raise ValueError('Unsupported search key %s' % key)
+
+
+def sort(messages, keys):
+    'Sort messages by the given sort keys'
+    def get_value(message, key):
+        valueByKey = message.get_valueByKey()
+        if 'ARRIVAL' == key:
+            return message.internalDate
+        if 'DATE' == key:
+            return message.get_sentDate()
+        if 'SIZE' == key:
+            return len(message.string)
+        if 'SUBJECT' == key:
+            return imapIO.PATTERN_WHITESPACE.sub(' ', valueByKey.get('subject', '')).strip().lower()
+        if key in ('FROM', 'TO', 'CC'):
+            addresses = getaddresses(valueByKey.get_all(key, []))
+            return addresses[0][1].lower() if addresses else ''
+        raise ValueError('Unsupported sort key %s' % key)
+    messages = sorted(messages, key=lambda x: x.uid)
+    keys = [x.upper() for x in keys]
+    # Apply stable sorts from the last key to the first so that the first key takes precedence
+    for index in reversed(xrange(len(keys))):
+        key = keys[index]
+        if 'REVERSE' == key:
+            continue
+        reverse = index > 0 and 'REVERSE' == keys[index - 1]
+        messages.sort(key=lambda x: get_value(x, key), reverse=reverse)
+    return messages
+
+
+def parse_messageSet(messageSet, maximumUID):
+    'Convert a messageSet such as 1,3:5,7:* into a list of (first, last) ranges'
+    ranges = []
+    for part in str(messageSet).split(','):
+        first, _, last = part.partition(':')
+        first = maximumUID if first == '*' else int(first)
+        last = first if not last else maximumUID if last == '*' else int(last)
+        ranges.append((min(first, last), max(first, last)))
+    return ranges
+
+
+def find_index(messages, uid):
+    'Return the index of the first message whose UID is at least uid, where messages are in UID order'
+    low, high = 0, len(messages)
+    while low < high:
+        middle = (low + high) // 2
+        if messages[middle].uid < uid:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+def parse_searchDate(text):
+    day, month, year = text.split('-')
+    return datetime.date(int(year), MONTHS.index(month.upper()) + 1, int(day))
+
+
+def parse_internalDate(text):
+    'Convert an internal date such as "23-Jan-2005 01:00:00 +0000" into seconds since the epoch'
+    dayText, timeText, zoneText = text.split()
+    day = parse_searchDate(dayText)
+    hour, minute, second = [int(x) for x in timeText.split(':')]
+    offset = (int(zoneText[1:3]) * 60 + int(zoneText[3:5])) * 60 * (-1 if zoneText.startswith('-') else 1)
+    return calendar.timegm((day.year, day.month, day.day, hour, minute, second)) - offset
+
+
+def format_internalDate(timeStamp):
+    return '"%s"' % time.strftime('%d-%b-%Y %H:%M:%S +0000', time.gmtime(timeStamp))
+
+
+def seed_mailboxes(server, user, folderCount=3, messageCount=100, bodySize=1000, attachmentSize=0, seed=0):
+    """
+    Fill folders of the account with synthetic messages.
+    The same seed produces the same messages.
+    Return the number of messages added.
+    """
+    randomGenerator = random.Random(seed)
+    mailboxByName = server.mailboxesByUser[user]
+    folders = ['INBOX'] + ['Folder %s' % x for x in xrange(1, folderCount)]
+    for folder in folders:
+        mailboxByName.setdefault(folder, Mailbox(folder))
+    def make_text(size):
+        words = []
+        while sum(len(x) + 1 for x in words) < size:
+            words.append(randomGenerator.choice(WORDS))
+        return ' '.join(words)
+    senders = ['%s.%s@example.com' % (randomGenerator.choice(WORDS), randomGenerator.choice(WORDS)) for x in xrange(20)]
+    attachmentPaths = None
+    if attachmentSize:
+        attachmentPath = tempfile.mkstemp(suffix='.bin')[1]
+        with open(attachmentPath, 'wb') as attachmentFile:
+            attachmentFile.write(''.join(chr(randomGenerator.randint(0, 255)) for x in xrange(attachmentSize)))
+        attachmentPaths = [attachmentPath]
+    try:
+        for messageIndex in xrange(messageCount):
+            whenUTC = datetime.datetime(2005, 1, 1) + datetime.timedelta(minutes=randomGenerator.randint(0, 60 * 24 * 365 * 5))
+            message = imapIO.build_message(
+                whenUTC=whenUTC,
+                subject=make_text(30).title(),
+                fromWhom=randomGenerator.choice(senders),
+                toWhom=randomGenerator.choice(senders),
+                bodyText=make_text(bodySize),
+                bodyHTML='<html>%s</html>' % make_text(bodySize) if messageIndex % 2 else '',
+                attachmentPaths=attachmentPaths)
+            message['message-id'] = '<%s@example.com>' % messageIndex
+            string = message.as_string().replace('\r\n', '\n').replace('\n', '\r\n')
+            mailboxByName[folders[messageIndex % len(folders)]].add(string, internalDate=calendar.timegm(whenUTC.timetuple()))
+    finally:
+        if attachmentPaths:
+            os.remove(attachmentPaths[0])
+    return messageCount
@@ -0,0 +1,299 @@
+"""
+Run jobs across many mailboxes with bounded connections per host.
+
+Export every mailbox, accounts with the most new messages first.
+    scheduler = Scheduler(connectionCount=64, connectionCountPerHost=8)
+    for host, user, password in accounts:
+        scheduler.add(host, user, password, lambda server: sum(1 for email in server.walk()),
+            uidNextByFolder=uidNextByFolderByUser.get(user))
+    statisticsByHost = scheduler.run()
+    # Remember where each account stopped so that the next run counts only new messages
+    uidNextByFolderByUser = dict((x.user, x.uidNextByFolder) for x in scheduler.accountByKey.itervalues())
+"""
+import collections
+import logging; log = logging.getLogger(__name__)
+import threading
+import time
+
+import imapIO
+
+
+class Scheduler(object):
+    'Process jobs for many accounts using a limited number of connections'
+
+    def __init__(self, connectionCount=32, connectionCountPerHost=4, connect=imapIO.connect, survey=True):
+        """
+        Set connectionCount to the maximum number of open connections.
+        Set connectionCountPerHost to the maximum number of open connections to each host.
+        Set connect to a function(host, port, user, password) that returns a server.
+        Set survey=False to skip counting pending messages with STATUS
+        for every account before running any jobs.
+        Connections to the same host share a RateController, so the number of
+        connections to a host shrinks below connectionCountPerHost while
+        the host throttles us and grows back when it recovers.
+        """
+        self.connectionCount = connectionCount
+        self.connectionCountPerHost = connectionCountPerHost
+        self.connect = connect
+        self.survey = survey
+        self.accountByKey = collections.OrderedDict()
+        self.rateControllerByHost = {}
+
+    def add(self, host, user, password, job, port=None, pendingCount=None, uidNextByFolder=None):
+        """
+        Add a job(server) for the account; jobs for the same account share a connection.
+        A job can return the number of messages that it processed.
+        Specify pendingCount to prioritize the account without counting its messages.
+        Specify uidNextByFolder from the last run so that the survey counts
+        only messages that arrived since then as pending.
+        """
+        key = host, user
+        account = self.accountByKey.get(key)
+        if account is None:
+            account = self.accountByKey[key] = Account(host, port, user, password)
+        account.jobs.append(job)
+        if pendingCount is not None:
+            account.pendingCount = pendingCount
+        if uidNextByFolder is not None:
+            account.uidNextByFolder = uidNextByFolder
+        return account
+
+    def get_rateController(self, host):
+        'Return the RateController shared by connections to the host'
+        rateController = self.rateControllerByHost.get(host)
+        if rateController is None:
+            rateController = self.rateControllerByHost[host] = imapIO.RateController.for_host(host)
+        return rateController
+
+    def open(self, account):
+        'Connect to the account using the RateController of its host'
+        server = self.connect(account.host, account.port, account.user, account.password)
+        server.rateController = self.get_rateController(account.host)
+        return server
+
+    def run(self):
+        """
+        Run jobs, accounts with the most pending messages first, so that the
+        largest accounts do not start last and determine the total time.
+        If survey=True, first log in to each account and count its pending
+        messages with STATUS, which orders accounts within this run.
+        Connections from the survey stay open for the jobs of their account
+        while connection limits allow, so that most accounts log in once.
+        Otherwise, accounts without a pendingCount start first, in the order
+        they were added, because any of them could be the largest.
+        Return statistics by host.
+        """
+        accounts = self.accountByKey.values()
+        for account in accounts:
+            self.get_rateController(account.host)
+        statisticsByHost = collections.OrderedDict()
+        for account in accounts:
+            statisticsByHost.setdefault(account.host, dict(
+                accountCount=0,
+                failureCount=0,
+                messageCount=0,
+                byteCount=0,
+                timeStarted=None,
+                timeFinished=None))
+        lock = threading.Lock()
+        def process(account):
+            timeStarted = time.time()
+            account.process(self)
+            with lock:
+                statistics = statisticsByHost[account.host]
+                statistics['accountCount'] += 1
+                statistics['failureCount'] += len(account.errors)
+                statistics['messageCount'] += account.messageCount
+                statistics['byteCount'] += account.byteCount
+                statistics['timeStarted'] = min(statistics['timeStarted'] or timeStarted, timeStarted)
+                statistics['timeFinished'] = max(statistics['timeFinished'], time.time())
+        # Count open connections by host, including those that accounts hold between tasks
+        self.connectionCountByHost = collections.defaultdict(int)
+        self.heldAccounts = []
+        if self.survey:
+            failedAccounts = set()
+            def survey(account):
+                if not account.survey(self):
+                    failedAccounts.add(account)
+            self._run_tasks([(x, lambda x=x: survey(x)) for x in accounts])
+            # Do not try again to log in to accounts that refused us
+            for account in failedAccounts:
+                statistics = statisticsByHost[account.host]
+                statistics['accountCount'] += 1
+                statistics['failureCount'] += len(account.errors)
+            accounts = [x for x in accounts if x not in failedAccounts]
+        self._run_tasks([(x, lambda x=x: process(x)) for x in accounts])
+        for account in self.heldAccounts:
+            account.close()
+        for statistics in statisticsByHost.itervalues():
+            seconds = (statistics['timeFinished'] or 0) - (statistics['timeStarted'] or 0)
+            statistics['seconds'] = seconds
+            statistics['messagesPerSecond'] = statistics['messageCount'] / seconds if seconds else 0
+            statistics['bytesPerSecond'] = statistics['byteCount'] / seconds if seconds else 0
+        return statisticsByHost
+
+    def _run_tasks(self, tasks):
+        'Run (account, function) tasks in threads, highest priority first, within connection limits'
+        tasks = sorted(tasks, key=lambda x: -x[0].priority)
+        condition = threading.Condition()
+        connectionCountByHost = self.connectionCountByHost
+        heldAccounts = self.heldAccounts
+        def work():
+            while True:
+                idleAccount = None
+                with condition:
+                    while True:
+                        if not tasks:
+                            return
+                        # Take the most important task whose host has a free connection
+                        for index, (account, function) in enumerate(tasks):
+                            host = account.host
+                            # Use the connection that the account already holds
+                            if account in heldAccounts:
+                                heldAccounts.remove(account)
+                                break
+                            isHostFull = connectionCountByHost[host] >= min(self.connectionCountPerHost, self.rateControllerByHost[host].connectionCount)
+                            isFull = sum(connectionCountByHost.itervalues()) >= self.connectionCount
+                            if not isHostFull and not isFull:
+                                connectionCountByHost[host] += 1
+                                break
+                            # Close the idle connection of the least important account in the way
+                            idleAccounts = [x for x in heldAccounts if x.host == host or not isHostFull]
+                            if idleAccounts:
+                                idleAccount = min(idleAccounts, key=lambda x: x.priority)
+                                heldAccounts.remove(idleAccount)
+                                connectionCountByHost[idleAccount.host] -= 1
+                                connectionCountByHost[host] += 1
+                                break
+                        else:
+                            # Wake up periodically because limits can grow without a task finishing
+                            condition.wait(1)
+                            continue
+                        tasks.pop(index)
+                        break
+                if idleAccount is not None:
+                    idleAccount.close()
+                try:
+                    function()
+                except Exception, error:
+                    log.error('[%s] %s' % (account, error))
+                finally:
+                    with condition:
+                        # Hold the connection for a later task unless a waiting task needs it now
+                        isHeld = account.server is not None and not any(x.host == account.host for x, y in tasks)
+                        if isHeld:
+                            heldAccounts.append(account)
+                        else:
+                            connectionCountByHost[account.host] -= 1
+                        condition.notify_all()
+                    if not isHeld:
+                        account.close()
+        threads = [threading.Thread(target=work) for x in xrange(min(self.connectionCount, len(tasks)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+
+class Account(object):
+    'Mailbox with jobs for a Scheduler'
+
+    def __init__(self, host, port, user, password):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.jobs = []
+        self.pendingCount = None
+        # Map each folder to (messageCount, uidNext) from STATUS
+        self.packByFolder = {}
+        # Map each folder to its UIDNEXT when we last processed it
+        self.uidNextByFolder = {}
+        self.server = None
+        self.results = []
+        self.errors = []
+        self.messageCount = 0
+        self.byteCount = 0
+
+    def __str__(self):
+        return '%s %s' % (self.host, self.user)
+
+    @property
+    def priority(self):
+        'Prefer accounts with more pending messages and accounts that we have not counted'
+        return float('inf') if self.pendingCount is None else self.pendingCount
+
+    def count(self, server):
+        'Count messages that arrived in each folder since we last processed it with STATUS'
+        self.packByFolder = server.count_messages()
+        pendingCount = 0
+        for folder, (messageCount, uidNext) in self.packByFolder.iteritems():
+            lastUIDNext = self.uidNextByFolder.get(folder)
+            # Count every message in new folders and in folders whose UIDs went back
+            if lastUIDNext is None or uidNext < lastUIDNext:
+                pendingCount += messageCount
+            else:
+                pendingCount += min(messageCount, uidNext - lastUIDNext)
+        self.pendingCount = pendingCount
+
+    def survey(self, scheduler):
+        'Log in and count pending messages, keeping the connection for the jobs; return False if we cannot log in'
+        try:
+            self.server = scheduler.open(self)
+        except imapIO.IMAPError, error:
+            log.error(error)
+            self.errors.append(error)
+            return False
+        try:
+            self.count(self.server)
+        except imapIO.IMAPError, error:
+            log.error(error)
+            self.errors.append(error)
+        return True
+
+    def process(self, scheduler):
+        'Run jobs on a single connection'
+        if self.server is not None:
+            # Servers drop connections that stay idle for too long
+            try:
+                self.server.noop()
+            except Exception:
+                self.close()
+        if self.server is None:
+            try:
+                self.server = scheduler.open(self)
+            except imapIO.IMAPError, error:
+                log.error(error)
+                self.errors.append(error)
+                return
+        server = self.server
+        try:
+            isComplete = True
+            for job in self.jobs:
+                try:
+                    result = job(server)
+                except Exception, error:
+                    log.error(server.format_error('Job failed', error))
+                    self.errors.append(error)
+                    isComplete = False
+                    continue
+                self.results.append(result)
+                if isinstance(result, (int, long)):
+                    self.messageCount += result
+            # Remember how far we got so that the next survey counts only new messages
+            if isComplete and self.packByFolder:
+                self.uidNextByFolder = dict((folder, uidNext) for folder, (messageCount, uidNext) in self.packByFolder.iteritems())
+        finally:
+            self.close()
+
+    def close(self):
+        'Log out of the connection that the account holds'
+        server, self.server = self.server, None
+        if server is None:
+            return
+        self.byteCount += server.receivedByteCount
+        try:
+            server.logout()
+        except Exception:
+            pass
@@ -3,24 +3,32 @@
 import os
 import random
 import tempfile
+import threading
 import unittest
 import datetime
+import itertools
 import ConfigParser
+import StringIO
 import logging; logging.basicConfig()
 
 import imapIO
+from imapIO.fake_server import FakeIMAPServer, Mailbox, find_index, seed_mailboxes
+from imapIO.scheduler import Scheduler
 from imapIO.utf_7_imap4 import CODEC_NAME
 
 
+# Test against a real account if there is a configuration file called .test.ini
 configuration = ConfigParser.ConfigParser()
-if not configuration.read('.test.ini'):
-    raise Exception('Please create a configuration file called .test.ini')
-getX = lambda x: configuration.get('imap', x)
-host = getX('host')
-port = int(getX('port'))
-user = getX('user')
-password = getX('password')
-ssl = getX('ssl').lower() == 'true'
+configured = bool(configuration.read('.test.ini'))
+if configured:
+    getX = lambda x: configuration.get('imap', x)
+    host = getX('host')
+    port = int(getX('port'))
+    user = getX('user')
+    password = getX('password')
+    ssl = getX('ssl').lower() == 'true'
+else:
+    ssl = None
 
 
 class Base(object):
@@ -143,7 +151,7 @@ class Base(object):
         self.server.expunge()
 
 
-@unittest.skipIf(ssl, 'not configured')
+@unittest.skipIf(not configured or ssl, 'not configured')
 class TestIMAP4(unittest.TestCase, Base):
 
     def setUp(self):
@@ -151,7 +159,7 @@ class TestIMAP4(unittest.TestCase, Base):
             self.server = imapIO.IMAP4.connect(host, port, user, password)
 
 
-@unittest.skipIf(not ssl, 'not configured')
+@unittest.skipIf(not configured or not ssl, 'not configured')
 class TestIMAP4_SSL(unittest.TestCase, Base):
 
     def setUp(self):
@@ -159,6 +167,207 @@ class TestIMAP4_SSL(unittest.TestCase, Base):
             self.server = imapIO.connect(host, port, user, password)
 
 
+class TestFakeIMAP4(unittest.TestCase, Base):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.fakeServer = FakeIMAPServer()
+        cls.fakeServer.add_account('user', 'password')
+        seed_mailboxes(cls.fakeServer, 'user', folderCount=3, messageCount=30)
+        cls.fakeServer.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.fakeServer.stop()
+
+    def setUp(self):
+        host, port = self.fakeServer.server_address
+        self.server = imapIO.IMAP4.connect(host, port, 'user', 'password')
+
+    def tearDown(self):
+        Base.tearDown(self)
+        self.server.logout()
+
+    def test_threads(self):
+        messageCount = self.server.cd('inbox')
+        threadPacks = self.server.threads('inbox')
+        self.assertEqual(len(list(imapIO.walk_threads(threadPacks))), messageCount)
+
+    def test_count_messages(self):
+        self.server.monitor = imapIO.Monitor()
+        packByFolder = self.server.count_messages()
+        self.assertEqual(sum(x for x, y in packByFolder.itervalues()), 30)
+        # Count with STATUS without selecting any folder
+        self.assertEqual(sorted(x[1] for x in self.server.monitor.statisticsByKey), ['LIST', 'STATUS'])
+
+    def test_scan(self):
+        batches = list(self.server.scan(batchSize=7))
+        self.assertEqual(max(len(x) for x in batches), 7)
+        packs = set()
+        for batch in batches:
+            columns = batch.as_columns()
+            packs.update(zip(columns['folder'], columns['uid'], columns['subject'], columns['sender']))
+        self.assertEqual(packs, set((x.folder, x.uid, x.subject, x.fromWhom) for x in self.server.walk()))
+        targetFile = StringIO.StringIO()
+        batches[0].write_csv(targetFile)
+        self.assertEqual(len(targetFile.getvalue().splitlines()), len(batches[0]) + 1)
+
+    def test_revive_stream(self):
+        attachmentPath = 'MANIFEST.in'
+        # Include text with Windows line endings
+        textPath = tempfile.mkstemp(suffix='.txt')[1]
+        self.temporaryPaths = [textPath]
+        open(textPath, 'wb').write('one\r\ntwo\r\n')
+        attachmentStreamSize = imapIO.ATTACHMENT_STREAM_SIZE
+        imapIO.ATTACHMENT_STREAM_SIZE = 0
+        try:
+            message = imapIO.build_message(subject='Stream', bodyHTML='<html>\r\n</html>', attachmentPaths=[textPath, attachmentPath], stream=True)
+        finally:
+            imapIO.ATTACHMENT_STREAM_SIZE = attachmentStreamSize
+        self.assertEqual(len(message.streamedPathByIndex), 1)
+        self.assertEqual(message.get_size(), len(message.as_string()))
+        # Send the same bytes that append() would send
+        literal = imapIO._StreamedLiteral(message)
+        self.assertEqual(''.join(literal), imapIO.imaplib.MapCRLF.sub('\r\n', message.as_string()))
+        self.assertEqual(len(literal), len(''.join(literal)))
+        self.server.revive('inbox', message)
+        for email in self.server.walk('inbox', searchCriterion='SUBJECT Stream'):
+            partPacks = email.extract()
+            email.deleted = True
+        self.server.expunge()
+        self.assertEqual(partPacks[-1][1], attachmentPath)
+        self.assertEqual(partPacks[-1][-1], open(attachmentPath, 'rb').read())
+
+    def test_unselectable_folder(self):
+        mailboxByName = self.fakeServer.mailboxesByUser['user']
+        mailboxByName['[Gmail]'] = Mailbox('[Gmail]', selectable=False)
+        try:
+            messageCount = sum(1 for x in self.server.walk())
+            # Skip folders that we cannot select instead of giving up
+            self.assertEqual(sum(len(x) for x in self.server.scan()), messageCount)
+            self.assertEqual(self.server.find_duplicates(), [])
+            with self.assertRaises(imapIO.IMAPError):
+                self.server.threads('"[Gmail]"')
+        finally:
+            del mailboxByName['[Gmail]']
+
+    def test_find_duplicates(self):
+        self.server.cd('inbox')
+        email = self.server.walk('inbox').next()
+        self.server.uid('copy', email.uid, 'Folder 1')
+        emailGroups = self.server.find_duplicates()
+        self.assertEqual([len(x) for x in emailGroups], [2])
+        self.server.remove_duplicates(emailGroups)
+        self.server.cd(emailGroups[0][1].folder)
+        self.server.expunge()
+        self.assertEqual(self.server.find_duplicates(), [])
+
+
+class TestScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.fakeServer = FakeIMAPServer()
+        for user, messageCount in [('small', 2), ('large', 9), ('medium', 5)]:
+            self.fakeServer.add_account(user, 'password')
+            seed_mailboxes(self.fakeServer, user, folderCount=2, messageCount=messageCount)
+        self.fakeServer.start()
+
+    def tearDown(self):
+        self.fakeServer.stop()
+
+    def test_run(self):
+        host, port = self.fakeServer.server_address
+        connectedUsers = []
+        def connect(host, port, user, password):
+            connectedUsers.append(user)
+            return imapIO.IMAP4.connect(host, port, user, password)
+        users = []
+        def walk(server):
+            users.append(server.user)
+            return sum(1 for email in server.walk())
+        def make_scheduler(uidNextByFolderByUser):
+            scheduler = Scheduler(connectionCountPerHost=1, connect=connect)
+            for user in 'small', 'large', 'medium':
+                scheduler.add(host, user, 'password', walk, port=port, uidNextByFolder=uidNextByFolderByUser.get(user))
+            return scheduler
+        scheduler = make_scheduler({})
+        scheduler.add(host, 'large', 'password', lambda server: server.count_messages(), port=port)
+        scheduler.add(host, 'missing', 'password', walk, port=port)
+        statisticsByHost = scheduler.run()
+        # Survey every account before processing the largest accounts first
+        self.assertEqual(users, ['large', 'medium', 'small'])
+        self.assertEqual(connectedUsers, ['small', 'large', 'medium', 'missing', 'large', 'medium', 'small'])
+        statistics = statisticsByHost[host]
+        self.assertEqual(statistics['accountCount'], 4)
+        self.assertEqual(statistics['failureCount'], 1)
+        self.assertEqual(statistics['messageCount'], 16)
+        account = scheduler.accountByKey[host, 'large']
+        self.assertEqual(sorted(account.results[1].values()), [(4, 5), (5, 6)])
+        self.assertEqual(account.packByFolder, account.results[1])
+        self.assertEqual(account.pendingCount, 9)
+        self.assertEqual(sorted(account.uidNextByFolder.values()), [5, 6])
+        # Count only messages that arrived since the last run
+        for index in xrange(3):
+            self.fakeServer.mailboxesByUser['medium']['INBOX'].add('Subject: New\r\n\r\nHello\r\n')
+        uidNextByFolderByUser = dict((x.user, x.uidNextByFolder) for x in scheduler.accountByKey.itervalues())
+        del users[:]
+        del connectedUsers[:]
+        scheduler = make_scheduler(uidNextByFolderByUser)
+        scheduler.run()
+        self.assertEqual([scheduler.accountByKey[host, x].pendingCount for x in 'small', 'large', 'medium'], [0, 0, 3])
+        self.assertEqual(users, ['medium', 'small', 'large'])
+        # Reuse the connection from the survey when no other account is waiting for it
+        self.assertEqual(connectedUsers, ['small', 'large', 'medium', 'small', 'large'])
+
+
+class TestRateController(unittest.TestCase):
+
+    def test_aimd(self):
+        rateController = imapIO.RateController(batchSize=10, batchIncrement=5, connectionCount=4, maximumBatchSize=20)
+        rateController.record_success(1, 10)
+        rateController.record_success(1, 10)
+        rateController.record_success(1, 10)
+        self.assertEqual(rateController.batchSize, 20)
+        self.assertEqual(rateController.connectionCount, 4)
+        # Shrink batches but not connections if a command fails
+        rateController.record_failure()
+        self.assertEqual((rateController.batchSize, rateController.connectionCount), (10, 4))
+        # Shrink both if the server throttles us
+        rateController.record_failure(throttled=True)
+        self.assertEqual((rateController.batchSize, rateController.connectionCount), (5, 2))
+        self.assertEqual(rateController.get_delay(1), 2)
+        # Shrink both if commands slow down
+        rateController.record_success(0.5, 5)
+        self.assertEqual((rateController.batchSize, rateController.connectionCount), (10, 2))
+        rateController.record_success(10, 10)
+        self.assertEqual((rateController.batchSize, rateController.connectionCount), (5, 1))
+        self.assertEqual(rateController.get_delay(1), 1)
+
+    def test_recover(self):
+        rateController = imapIO.RateController()
+        # Spend most of the time of small batches on the round trip
+        get_duration = lambda messageCount: 0.05 + 0.0005 * messageCount
+        for index in xrange(300):
+            rateController.record_success(get_duration(rateController.batchSize), rateController.batchSize)
+        self.assertEqual((rateController.batchSize, rateController.connectionCount), (1000, 16))
+        for index in xrange(6):
+            rateController.record_failure(throttled=True)
+        self.assertEqual((rateController.batchSize, rateController.connectionCount), (15, 1))
+        # Do not mistake smaller batches for a slower server
+        for index in xrange(300):
+            rateController.record_success(get_duration(rateController.batchSize), rateController.batchSize)
+        self.assertEqual((rateController.batchSize, rateController.connectionCount), (1000, 16))
+
+    def test_for_host(self):
+        self.assertEqual(imapIO.RateController.for_host('IMAP.mail.yahoo.com').batchSize, 20)
+        self.assertEqual(imapIO.RateController.for_host('imap.example.com').batchSize, imapIO.FETCH_BATCH_SIZE)
+
+    def test_is_throttled(self):
+        assert imapIO.is_throttled(['[THROTTLED] Too fast'])
+        assert imapIO.is_throttled(['[UNAVAILABLE] Try again later'])
+        assert not imapIO.is_throttled(['[NONEXISTENT] No such mailbox'])
+
+
 class TestExceptions_IMAPExtension(unittest.TestCase):
 
     def setUp(self):
@@ -191,6 +400,243 @@ class TestExceptions_IMAPExtension(unittest.TestCase):
         with self.assertRaises(StopIteration):
             self.server.walk('bbb').next()
 
+    def test_walk_checkpoint(self):
+        self.server.cd = lambda a='': None
+        self.server.list = lambda: ('OK', ['() "/" aaa', '() "/" bbb', '() "/" ccc'])
+        self.server.uid = lambda a, b, c, d=None: ('OK', ['1 2 3'] if a == 'search' else format_fetch(b, 'Subject: A\r\n\r\n'))
+        shuffle = imapIO.random.shuffle
+        imapIO.random.shuffle = lambda x: x.reverse()
+        try:
+            checkpoint = imapIO.Checkpoint()
+            emailGenerator = self.server.walk(shuffleMessages=False, checkpoint=checkpoint)
+            # Interrupt the walk in the middle of the second folder
+            keys = [(x.folder, x.uid) for x in itertools.islice(emailGenerator, 5)]
+            # Save progress and resume
+            targetPath = tempfile.mkstemp()[1]
+            checkpoint.save(targetPath)
+            checkpoint = imapIO.Checkpoint.load(targetPath)
+            os.remove(targetPath)
+            self.assertEqual(checkpoint.folders, set(['ccc']))
+            self.assertEqual((checkpoint.folder, checkpoint.messageUIDs), ('bbb', set([1])))
+            self.assertEqual(checkpoint.uidValidityByFolder, {'bbb': 1, 'ccc': 1})
+            # Visit folders in a different order, where the interrupted folder is not first
+            self.server.list = lambda: ('OK', ['() "/" ccc', '() "/" bbb', '() "/" aaa'])
+            keys.extend((x.folder, x.uid) for x in self.server.walk(shuffleMessages=False, checkpoint=checkpoint))
+        finally:
+            imapIO.random.shuffle = shuffle
+        # Only the last message before the interruption is yielded again
+        self.assertEqual(len(keys), 10)
+        self.assertEqual(len(set(keys)), 9)
+        self.assertEqual(keys[5], ('bbb', 2))
+        self.assertEqual(checkpoint.folders, set(['aaa', 'bbb', 'ccc']))
+
+    def test_walk_checkpoint_uidValidity(self):
+        self.server.list = lambda: ('OK', ['() "/" aaa'])
+        self.server.uid = lambda a, b, c, d=None: ('OK', ['1 2 3'] if a == 'search' else format_fetch(b, 'Subject: A\r\n\r\n'))
+        checkpoint = imapIO.Checkpoint()
+        list(itertools.islice(self.server.walk(shuffleMessages=False, checkpoint=checkpoint), 3))
+        self.assertEqual(checkpoint.messageUIDs, set([1, 2]))
+        # Forget progress in a folder whose messages the server renumbered
+        self.server.response = lambda code: (code, ['2'])
+        self.assertEqual([x.uid for x in self.server.walk(shuffleMessages=False, checkpoint=checkpoint)], [1, 2, 3])
+        self.assertEqual(checkpoint.uidValidityByFolder, {'aaa': 2})
+
+    def test_reconnect(self):
+        self.server.cd = lambda a='': None
+        self.server.list = lambda: ('OK', ['() "/" aaa'])
+        abortCount = [2]
+        def uid(a, b, c, d=None):
+            if a == 'fetch' and abortCount[0]:
+                abortCount[0] -= 1
+                raise imapIO.imaplib.IMAP4.abort
+            return 'OK', ['1'] if a == 'search' else format_fetch(b, 'Subject: A\r\n\r\n')
+        self.server.uid = uid
+        reopenCount = [0]
+        def reopen():
+            reopenCount[0] += 1
+            # Fail the first attempt to reconnect
+            if reopenCount[0] == 1:
+                raise imapIO.imaplib.IMAP4.error
+        self.server.reopen = reopen
+        self.server.login = lambda user, password: None
+        self.server.password = ''
+        self.assertEqual([x.uid for x in self.server.walk()], [1])
+        self.assertEqual(reopenCount[0], 3)
+        def reopen():
+            raise imapIO.imaplib.IMAP4.error
+        self.server.reopen = reopen
+        with self.assertRaises(imapIO.IMAPError):
+            self.server.reconnect()
+        # Fail without waiting if the server cannot open a new connection
+        del self.server.reopen
+        with self.assertRaises(imapIO.IMAPError):
+            self.server.reconnect()
+
+    def test_walk_throttled(self):
+        self.server.cd = lambda a='': None
+        self.server.list = lambda: ('OK', ['() "/" aaa'])
+        self.server.rateController = imapIO.RateController(batchSize=4)
+        responses = [('NO', ['[THROTTLED] Slow down'])]
+        messageSets = []
+        def uid(a, b, c, d=None):
+            if a == 'search':
+                return responses.pop(0) if responses else ('OK', [' '.join(str(x) for x in xrange(1, 11))])
+            messageSets.append(b)
+            # Throttle the first fetch
+            if len(messageSets) == 1:
+                return 'NO', ['[THROTTLED] Slow down']
+            return 'OK', format_fetch(b, 'Subject: A\r\n\r\n')
+        self.server.uid = uid
+        # Retry the throttled search and fetch instead of skipping messages
+        self.assertEqual([x.uid for x in self.server.walk(shuffleMessages=False)], range(1, 11))
+        # Halve the batch size after each throttled command
+        self.assertEqual(messageSets[:2], ['1,2', '1'])
+        self.assertEqual(self.server.rateController.failureCount, 0)
+
+    def test_walk_broken(self):
+        self.server.cd = lambda a='': None
+        self.server.list = lambda: ('OK', ['() "/" aaa'])
+        # Keep batches large even after failures
+        self.server.rateController = imapIO.RateController(batchSize=100, minimumBatchSize=100, maximumBatchSize=100)
+        messageSets = []
+        def uid(a, b, c, d=None):
+            if a == 'search':
+                return 'OK', [' '.join(str(x) for x in xrange(1, 201))]
+            messageSets.append(b)
+            # Fail every batch that includes the broken message
+            if '50' in b.split(','):
+                return 'NO', ['Broken message']
+            return 'OK', format_fetch(b, 'Subject: A\r\n\r\n')
+        self.server.uid = uid
+        # Split failing batches so that only the broken message is skipped
+        self.assertEqual([x.uid for x in self.server.walk(shuffleMessages=False)], range(1, 50) + range(51, 201))
+        self.assertEqual(self.server.skippedUIDsByFolder, {'aaa': [50]})
+        self.assertEqual([len(x.split(',')) for x in messageSets], [100] * 4 + [50, 25, 25, 12, 12, 1, 50, 100])
+
+    def test_threads(self):
+        self.server.cd = lambda a='': None
+        headerByUID = {
+            1: 'Message-ID: <a@x>\r\nSubject: A\r\n\r\n',
+            2: 'Message-ID: <b@x>\r\nIn-Reply-To: <a@x>\r\nSubject: B\r\n\r\n',
+            3: 'Message-ID: <c@x>\r\nReferences: <a@x> <z@x>\r\nSubject: C\r\n\r\n',
+            4: 'Message-ID: <d@x>\r\nSubject: D\r\n\r\n',
+        }
+        def uid(command, *args):
+            if command == 'thread':
+                return 'OK', ['(1 (2)(3))(4)']
+            if command == 'search':
+                return 'OK', [' '.join(str(x) for x in headerByUID)]
+            data = []
+            for messageUID in args[0].split(','):
+                header = headerByUID[int(messageUID)]
+                data.extend([('%s (UID %s BODY[HEADER] {%s}' % (messageUID, messageUID, len(header)), header), ')'])
+            return 'OK', data
+        self.server.uid = uid
+        def summarize(threadPacks):
+            return [(email.subject if email else None, summarize(childPacks)) for email, childPacks in threadPacks]
+        # Use the THREAD extension
+        self.server.capabilities = ['THREAD=REFERENCES']
+        self.assertEqual(summarize(self.server.threads('aaa')), [
+            ('A', [('B', []), ('C', [])]),
+            ('D', []),
+        ])
+        # Build threads locally
+        self.server.capabilities = []
+        self.assertEqual(summarize(self.server.threads('aaa')), [
+            ('A', [('B', []), ('C', [])]),
+            ('D', []),
+        ])
+        self.server.uid = lambda *args: ('xxx', [])
+        with self.assertRaises(imapIO.IMAPError):
+            self.server.threads('aaa')
+        self.server.capabilities = ['THREAD=REFERENCES']
+        with self.assertRaises(imapIO.IMAPError):
+            self.server.threads('aaa')
+        self.server.select = lambda folder: ('NO', ['Mailbox does not exist'])
+        with self.assertRaises(imapIO.IMAPError):
+            self.server.threads('aaa')
+
+    def test_threads_deep(self):
+        # Follow long reply chains without exhausting the stack
+        messageCount = 1500
+        headerByUID = dict((x, 'Message-ID: <%s@x>\r\nIn-Reply-To: <%s@x>\r\n\r\n' % (x, x - 1)) for x in xrange(1, messageCount + 1))
+        def uid(command, *args):
+            if command == 'thread':
+                return 'OK', ['(%s)' % ' '.join(str(x) for x in sorted(headerByUID))]
+            if command == 'search':
+                return 'OK', [' '.join(str(x) for x in sorted(headerByUID))]
+            data = []
+            for messageUID in args[0].split(','):
+                header = headerByUID[int(messageUID)]
+                data.extend([('%s (UID %s BODY[HEADER] {%s}' % (messageUID, messageUID, len(header)), header), ')'])
+            return 'OK', data
+        self.server.uid = uid
+        for capabilities in ['THREAD=REFERENCES'], []:
+            self.server.capabilities = capabilities
+            threadPacks, depth = self.server.threads('aaa'), 0
+            while threadPacks:
+                self.assertEqual(len(threadPacks), 1)
+                email, threadPacks = threadPacks[0]
+                depth += 1
+            self.assertEqual(depth, messageCount)
+
+    def test_find_duplicates(self):
+        self.server.cd = lambda a='': None
+        self.server.list = lambda: ('OK', ['() "/" aaa', '() "/" bbb', '() "/" ccc'])
+        header = 'Message-ID: <a@x>\r\nSubject: A\r\n\r\n'
+        bodyByKey = {
+            ('aaa', 1): 'same',
+            ('bbb', 1): 'same',
+            ('bbb', 2): 'different',
+            ('ccc', 1): 'same',
+        }
+        selected = []
+        def select(folder=None):
+            selected.append(folder)
+            return 'OK', ['0']
+        self.server.select = select
+        def uid(command, *args):
+            folder = selected[-1]
+            if command == 'search':
+                if folder == 'ccc':
+                    return 'xxx', []
+                return 'OK', [' '.join(str(y) for x, y in bodyByKey if x == folder)]
+            data = []
+            for messageUID in args[0].split(','):
+                if 'TEXT' in args[1]:
+                    literal = bodyByKey[folder, int(messageUID)]
+                    prefix = '%s (UID %s BODY[TEXT] {%s}' % (messageUID, messageUID, len(literal))
+                else:
+                    literal = header
+                    prefix = '%s (UID %s RFC822.SIZE 100 BODY[HEADER] {%s}' % (messageUID, messageUID, len(literal))
+                data.extend([(prefix, literal), ')'])
+            return 'OK', data
+        self.server.uid = uid
+        emailGroups = self.server.find_duplicates()
+        self.assertEqual([[(x.folder, x.uid) for x in emails] for emails in emailGroups], [
+            [('aaa', 1), ('bbb', 1)],
+        ])
+        # Flag duplicates as deleted
+        commands = []
+        self.server.uid = lambda *args: commands.append(args) or ('OK', [])
+        self.server.capabilities = []
+        self.server.remove_duplicates(emailGroups)
+        self.assertEqual(commands, [('store', '1', '+FLAGS', r'(\Deleted)')])
+        # Move duplicates
+        del commands[:]
+        self.server.remove_duplicates(emailGroups, 'trash')
+        self.assertEqual(commands, [('copy', '1', 'trash'), ('store', '1', '+FLAGS', r'(\Deleted)')])
+        del commands[:]
+        self.server.capabilities = ['MOVE']
+        self.server.remove_duplicates(emailGroups, 'trash')
+        self.assertEqual(commands, [('move', '1', 'trash')])
+        self.server.uid = lambda *args: ('xxx', [])
+        with self.assertRaises(imapIO.IMAPError):
+            self.server.remove_duplicates(emailGroups, 'trash')
+        self.server.capabilities = []
+        with self.assertRaises(imapIO.IMAPError):
+            self.server.remove_duplicates(emailGroups, 'trash')
+
     def test_revive(self):
         self.server.cd = lambda a='': None
         self.server.list = lambda: ('OK', ['() "/" aaa'])
@@ -244,16 +690,119 @@ class TestExceptions_Email(unittest.TestCase):
         self.email['fromWhom'] = ''
 
 
+class TestMonitor(unittest.TestCase):
+
+    def setUp(self):
+        self.measurements = []
+        self.monitor = imapIO.Monitor(lambda *args: self.measurements.append(args))
+        self.server = IMAP4Socket()
+
+    def test_commands(self):
+        self.server.cd('aaa')
+        self.server.uid('fetch', '1', '(FLAGS)')
+        self.assertEqual(self.measurements, [])
+        self.server.monitor = self.monitor
+        self.server.uid('fetch', '1', '(FLAGS)')
+        self.server.uid('fetch', '2', '(FLAGS)')
+        self.assertEqual([x[:2] + x[3:] for x in self.measurements], [
+            ('command', 'UID FETCH', 'aaa', 19, 12),
+            ('command', 'UID FETCH', 'aaa', 19, 12),
+        ])
+        statistics = self.monitor.statisticsByKey['command', 'UID FETCH']
+        self.assertEqual(statistics['count'], 2)
+        self.assertEqual(statistics['receivedByteCount'], 24)
+        self.assertEqual(sum(statistics['histogram']), 2)
+
+    def test_select(self):
+        self.server.monitor = self.monitor
+        for folder in 'aaa', 'bbb', 'aaa':
+            self.server.cd(folder)
+        self.assertEqual([x[1:2] + x[3:4] for x in self.measurements], [
+            ('SELECT', 'aaa'),
+            ('SELECT', 'bbb'),
+            ('SELECT', 'aaa'),
+        ])
+
+    def test_threads(self):
+        monitor = imapIO.Monitor()
+        def record():
+            for index in xrange(1000):
+                monitor.record('command', 'NOOP', 0)
+        threads = [threading.Thread(target=record) for x in xrange(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(monitor.statisticsByKey['command', 'NOOP']['count'], 4000)
+
+    def test_parse(self):
+        self.server.monitor = self.monitor
+        email = imapIO.Email(self.server, 1, 'aaa', 'Subject: A\r\n\r\n')
+        email._string = 'Subject: A\r\n\r\nText'
+        email.extract()
+        self.assertEqual([x[:2] + x[3:4] for x in self.measurements], [
+            ('parse', 'Email', 'aaa'),
+            ('parse', 'extract', 'aaa'),
+        ])
+
+
 class IMAP4Dummy(imapIO._IMAPExtension):
     
     host = 'imap.mail.yahoo.com'
     port = ''
     user = ''
     error = Exception
+    retryDelay = 0
 
     def xatom(self, a):
         pass
 
+    def select(self, folder=None):
+        return 'OK', ['0']
+
+    def response(self, code):
+        return code, ['1']
+
+
+def format_fetch(messageSet, literal):
+    'Format a FETCH response the way imaplib returns it'
+    data = []
+    for messageUID in str(messageSet).split(','):
+        data.extend([('%s (UID %s BODY[HEADER] {%s}' % (messageUID, messageUID, len(literal)), literal), ')'])
+    return data
+
+
+class IMAP4Base:
+    'Stand-in for imaplib.IMAP4 that exchanges fixed strings'
+
+    def _simple_command(self, name, *args):
+        self.send(' '.join([name] + list(args)))
+        self.readline()
+        self.read(4)
+        return 'OK', ['']
+
+    def send(self, data):
+        pass
+
+    def read(self, size):
+        return 'x' * size
+
+    def readline(self):
+        return 'OK done\n'
+
+    def select(self, folder):
+        self._simple_command('SELECT', folder)
+        return 'OK', ['0']
+
+    def uid(self, command, *args):
+        return self._simple_command('UID', command, *args)
+
+
+class IMAP4Socket(IMAP4Dummy, IMAP4Base):
+
+    def select(self, folder=None):
+        return IMAP4Base.select(self, folder)
+
 
 def test_build_message():
     imapIO.mimetypes.guess_type = lambda a: (None, None)
@@ -266,6 +815,67 @@ def test_build_message():
     imapIO.build_message(attachmentPaths=['MANIFEST.in'])
 
 
+def test_build_message_cache():
+    partsByIndex = [imapIO.build_message(attachmentPaths=['CHANGES.rst']).get_payload() for x in xrange(2)]
+    assert partsByIndex[0][-1] is not partsByIndex[1][-1]
+    assert partsByIndex[0][-1].get_payload() is partsByIndex[1][-1].get_payload()
+    # Cache but do not, by default, stream large attachments
+    imapIO.attachmentCache.clear()
+    attachmentStreamSize = imapIO.ATTACHMENT_STREAM_SIZE
+    imapIO.ATTACHMENT_STREAM_SIZE = 0
+    try:
+        message = imapIO.build_message(attachmentPaths=['CHANGES.rst', 'MANIFEST.in'])
+    finally:
+        imapIO.ATTACHMENT_STREAM_SIZE = attachmentStreamSize
+    assert len(imapIO.attachmentCache.packByKey) == 2
+    assert not hasattr(message, 'streamedPathByIndex')
+    assert message.get_payload()[-1].get_payload(decode=True) == open('MANIFEST.in', 'rb').read()
+
+
+def test_attachmentCache():
+    attachmentCache = imapIO._AttachmentCache(10)
+    attachmentCache.set('a', 'A', 4)
+    attachmentCache.set('b', 'B', 4)
+    # Skip parts that are larger than the whole cache
+    attachmentCache.set('c', 'C', 11)
+    assert attachmentCache.get('c') is None
+    # Evict the least recently used parts until the total fits
+    assert attachmentCache.get('a') == 'A'
+    attachmentCache.set('d', 'D', 4)
+    assert attachmentCache.get('b') is None
+    assert attachmentCache.packByKey.keys() == ['a', 'd']
+    assert attachmentCache.size == 8
+
+
+def test_split_by_size():
+    assert list(imapIO.split_by_size([1, 2, 3, 4, 5], [5, 5, 20, 1, 1], 10)) == [[1, 2], [3], [4, 5]]
+    assert list(imapIO.split_by_size([], [], 10)) == []
+
+
+def test_find_index():
+    mailbox = Mailbox('aaa')
+    for index in xrange(5):
+        mailbox.add('Subject: A\r\n\r\n')
+    mailbox.messages.pop(2)
+    assert [find_index(mailbox.messages, x) for x in 0, 1, 3, 4, 6] == [0, 0, 2, 2, 4]
+
+
+def test_parse_headerFields():
+    assert imapIO.parse_headerFields('Subject: One\r\n two\r\nFROM: a@x\r\nFrom: b@x\r\nxxx\r\n\r\nDate: 1\r\n') == {
+        'subject': 'One two',
+        'from': 'a@x',
+    }
+
+
+def test_parse_threads():
+    assert imapIO.parse_threads('') == []
+    assert imapIO.parse_threads('(1 2)(3 (4)(5 6))((7)(8))') == [
+        (1, [(2, [])]),
+        (3, [(4, []), (5, [(6, [])])]),
+        (None, [(7, []), (8, [])]),
+    ]
+
+
 def test_normalize_nickname():
     assert imapIO.normalize_nickname('person.one@example.com') == 'Person One'
     assert imapIO.normalize_nickname('Mr. Person <person.one@example.com>') == 'Mr Person'